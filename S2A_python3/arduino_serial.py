@@ -21,8 +21,43 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
 import serial
-import sys
-import configparser
+import time
+import binary_codec
+import s2a_config
+
+
+class AckError(Exception):
+    """
+    Base class for problems with the "{}" acknowledgement the Arduino
+    sends for every mode and write command.
+
+    command is the name of the command or the frame that was sent,
+    reply is the line that was received in its place, if any.
+    """
+    def __init__(self, message, command=None, reply=None):
+        Exception.__init__(self, message)
+        self.command = command
+        self.reply = reply
+
+
+class BadAckError(AckError):
+    """
+    Something other than "{}" arrived where an acknowledgement was due
+    """
+
+
+class MissingAckError(AckError):
+    """
+    No acknowledgement arrived for a command, either before its deadline
+    or before the reply to a request sent after it
+    """
+
+
+class LateAckError(AckError):
+    """
+    An acknowledgement arrived when none was outstanding, usually for a
+    command that had already been given up on
+    """
 
 
 
@@ -37,23 +72,42 @@ class ArduinoSerial:
     
     # line of data, '\n' terminated, read from Arduino
     read_string = ""
+
+    # the longest frame we expect from the Arduino, not counting the '\n'
+    max_line_length = 80
     
     port_id =""
     baud_rate = 0
     timeout = 0
     
 
-    def __init__(self, config_file):
+    def __init__(self, config):
         """
-        Get configuration values for the serial port
+        Get configuration values for the serial port from config, an
+        S2AConfig or the name of a configuration file
         """
-        Config = configparser.ConfigParser()
-        Config.read(config_file)
+        config = s2a_config.load(config)
         
-        self.port_id = Config.get("SerialPortSection", "ComPort")
-        self.baud_rate = Config.get("SerialPortSection", "BaudRate")
-        self. timeout = Config.get("SerialPortSection", "TimeOut")
-        self.config_file = config_file
+        self.port_id = config.serial.com_port
+        self.baud_rate = config.serial.baud_rate
+        self.timeout = config.serial.timeout
+        self.config_file = config.config_file
+
+        # bytes received from the Arduino that have not yet been handed
+        # out as a line. Partial lines stay here between calls.
+        self.read_buffer = bytearray()
+
+        # set while the rest of an overlong line has yet to arrive, so
+        # that it is thrown away up to its line terminator
+        self.skipping_line = False
+
+        # set once the sketch has agreed to speak the binary protocol.
+        # Replies are then binary_codec records instead of lines.
+        self.binary_protocol = False
+
+        # counters for the /metrics page
+        self.overruns = 0
+        self.reconnects = 0
     
     def open(self):
         """ 
@@ -65,12 +119,10 @@ class ArduinoSerial:
         print('\nOpening Arduino Serial port %s ' % ( self.port_id ))
 
         try:
+            # the port is opened here. Closing and reopening it would
+            # reset the Arduino a second time.
             self.arduino = serial.Serial(self.port_id, self.baud_rate, 
-                                     timeout=int(self.timeout) )
-        # in case the port is already open, let's close it and then
-        #reopen it   
-            self.arduino.close()    
-            self.arduino.open()           
+                                     timeout=self.timeout )
             return self.arduino
         except Exception:
            # opened failed - will report back to caller
@@ -83,77 +135,204 @@ class ArduinoSerial:
             return: None
         """
         self.arduino.close()
+
+    def reopen(self):
+        """
+            Close the serial port, if it can still be closed, and open it
+            again, starting over in JSON with nothing buffered
+
+            return: a reference to the new port
+        """
+        try:
+            self.arduino.close()
+        except Exception:
+            # a port that has gone away may fail to close
+            pass
+        del self.read_buffer[:]
+        self.skipping_line = False
+        self.binary_protocol = False
+        port = self.open()
+        self.reconnects += 1
+        return port
                 
     def write(self, data):
         """
-            write the data to the serial port
+            write the data to the serial port. The data may be a string
+            or an already encoded frame.
             
             return: None
         """
         try:
-            self.arduino.write(data.encode('utf8'))
+            if isinstance(data, str):
+                data = data.encode('utf8')
+            self.arduino.write(data)
         except Exception:
             raise
 
     # keep reading in data until a new line is found
-    def read_line(self):
+    def read_line(self, deadline=None):
         """
             Read a line of data from the serial port
+
+            Whatever the port has waiting is pulled in with one read
+            and kept in a buffer, so that replies arriving back to back
+            are split out of the buffer without going back to the port.
+
+            deadline is an optional time.monotonic() time. The port's
+            TimeOut sets how closely it is kept.
+            
+            return: a line of data, or None if the deadline passed first
+        """
+        return self.read_until(self.next_line, deadline)
+
+    def read_reply(self, deadline=None):
+        """
+            Read the next reply from the serial port, a line of data or,
+            once the binary protocol is in use, a decoded binary record
             
-            return: a line of data
+            return: the reply, or None if the deadline passed first
         """
+        return self.read_until(self.next_reply, deadline)
 
-        self.read_string = ""
+    def read_until(self, next_item, deadline):
+        """
+            Feed the read buffer from the serial port until next_item()
+            can take something out of it
+            
+            return: what next_item() returned, or None if the deadline
+                    passed first
+        """
+        read_buffer = self.read_buffer
         while 1:
             try:
-                ch = self.arduino.read(1)
-                if(ch == b'\n'):  
-                    break
-                self.read_string += ch.decode('utf-8')
-                # check to make sure that we don't go on forever
-                if len(self.read_string) > 80:
-                    print("ArduinoSerial: read_line exceeded 80 characters")
-                    raise EOFError
+                line = next_item()
+                if line is not None:
+                    return line
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+
+                # wait for at least one byte, then take everything else
+                # that has arrived along with it
+                waiting = self.arduino.in_waiting
+                if waiting:
+                    read_buffer += self.arduino.read(waiting)
+                else:
+                    read_buffer += self.arduino.read(1)
+            except EOFError:
+                # an overlong line was thrown away. The replies behind it
+                # are still good, so nothing is flushed.
+                raise
             except Exception:
                self.clean_up()
                raise
-        return self.read_string
+
+    def next_reply(self):
+        """
+            Take the next complete reply out of the read buffer without
+            touching the serial port
+            
+            return: a line of data or a decoded binary record, or None
+        """
+        if self.binary_protocol:
+            return binary_codec.next_record(self.read_buffer)
+        return self.next_line()
+
+    def is_ack(self, reply):
+        """
+            return: True if the reply is the acknowledgement of a mode or
+                    write command
+        """
+        if self.binary_protocol:
+            return reply is not None and reply[0] == binary_codec.ACK
+        return reply == "{}"
+
+    def next_line(self):
+        """
+            Take the next complete line out of the read buffer without
+            touching the serial port
+            
+            return: a line of data or None if no full line has arrived
+        """
+        read_buffer = self.read_buffer
+        newline = read_buffer.find(b'\n')
+        if self.skipping_line:
+            # the tail of an overlong line
+            if newline < 0:
+                del read_buffer[:]
+                return None
+            del read_buffer[:newline + 1]
+            self.skipping_line = False
+            newline = read_buffer.find(b'\n')
+        if newline >= 0:
+            # check to make sure that we don't go on forever
+            if newline > self.max_line_length:
+                self.read_line_overrun()
+            line = read_buffer[:newline]
+            del read_buffer[:newline + 1]
+            self.read_string = line.decode('utf-8')
+            return self.read_string
+
+        # no complete line yet, so make sure that the partial
+        # line is not getting out of hand
+        if len(read_buffer) > self.max_line_length:
+            self.read_line_overrun()
+        return None
+
+    def read_line_overrun(self):
+        """
+            Throw away a line that is longer than any valid reply, up to
+            and including its line terminator. The replies after it stay
+            in the read buffer. If the terminator has not arrived yet,
+            the rest of the line is thrown away as it comes in.
+            
+            return: does not return, raises EOFError
+        """
+        print("ArduinoSerial: read_line exceeded %d characters" %
+              self.max_line_length)
+        self.overruns += 1
+        read_buffer = self.read_buffer
+        newline = read_buffer.find(b'\n')
+        if newline >= 0:
+            del read_buffer[:newline + 1]
+        else:
+            del read_buffer[:]
+            self.skipping_line = True
+        raise EOFError
 
         
-    def send_command(self, data):
+    def send_command(self, data, deadline=None):
         """
-            Send a command to the Arduino and wait for the "{}" reply
+            Send a command to the Arduino and wait for the "{}" reply,
+            until the optional time.monotonic() deadline
             
-            return: None
+            return: None, raises MissingAckError if the deadline passes
+                    and BadAckError if the reply is not "{}"
         """
         try:
             self.write(data)
-            reply = self.read_line()
+            reply = self.read_reply(deadline)
            
-            if reply == "{}":
+            if reply is None:
+                raise MissingAckError("send_command: no reply before the "
+                                      "deadline", data)
+            elif self.is_ack(reply):
                 pass
             else:
-                print("send_command: received bad reply %s" % (reply))
-                sys.exit(1)
+                raise BadAckError("send_command: received bad reply %s" %
+                                  (reply), data, reply)
         except Exception:
             raise
             
-    def get_data(self, poll_req):
-        """
-            Send a request for reporter data to the Arduino
-            
-            return: reporter reply string
-        """
+    def clean_up(self):
+        del self.read_buffer[:]
+        self.skipping_line = False
         try:
-            self.write(poll_req)
-            reply = self.read_line()
-            return reply
+            self.arduino.flushInput()
+            self.arduino.flushOutput()
         except Exception:
-            raise
-            
-    def clean_up(self):
-        self.arduino.flushInput()
-        self.arduino.flushOutput()
+            # a port that has gone away cannot be flushed. The error that
+            # got us here is the one to report.
+            pass
 
 
         
@@ -22,8 +22,20 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import threading
 import json
-import itertools
-import configparser
+import time
+import s2a_config
+import command_templates
+import poll_scheduler
+import drain_policy
+import binary_codec
+import reply_parser
+import metrics
+import command_trace
+import link_supervisor
+from arduino_serial import AckError, BadAckError
+from link_supervisor import LinkError
+from request_window import Request, RequestWindow
+from collections import deque
 
 
 class ArduinoTranslator(threading.Thread):
@@ -35,31 +47,92 @@ class ArduinoTranslator(threading.Thread):
 
    The class uses the configuration table data to determine Arduino control
 
-   It shares the scratch reporter dictionary, reporter lock and command
-    deque with the arduino_translator class       
+   It shares the reporter store and command deque with the
+   scratch_translator class
    """
    
-   # this map will be populated with reporter data
-   # it is protected by a thread lock
+   # this map translates the pin reported by the Arduino to the
+   # Scratch reporter label
    reporter_map = {}
-   
-   # a flag to provide special PWM pin processing affected by the servo
-   # and tone libraries provided by Arduino.
-   piezo_or_servo = False
+
+   # the name of the heartbeat read in the request window
+   HEARTBEAT = "heartbeat"
+
+   # how long, in seconds, to wait for the sketch to answer the status
+   # query after the port was opened again, and for each single query
+   handshake_time = 5.0
+   status_query_time = 1.0
    
 
 
         
-   def __init__(self, arduino, scratch_reporter_dict,reporter_lock, 
-                command_deque, config_file):
+   def __init__(self, arduino, reporter_store, command_deque, config):
        """
-       Constructor
+       Constructor. config is an S2AConfig, or the name of a
+       configuration file.
        """                   
        self.arduino = arduino         
-       self.scratch_reporter_dict = scratch_reporter_dict
-       self.reporter_lock = reporter_lock
+       self.reporter_store = reporter_store
        self.command_deque = command_deque
-       self.config_file = config_file
+       self.config = s2a_config.load(config)
+       self.config_file = self.config.config_file
+
+       # compile the JSON templates, command map and poll requests once so
+       # that the polling and command loops never go back to the
+       # configuration
+       self.templates = command_templates.CommandTemplates(self.config)
+
+       # the frames that are outstanding at the Arduino. Its limits are
+       # set from the configuration.
+       self.window = RequestWindow()
+
+       # a configuration handed over by reload(), and the pin mode and
+       # output frames it still has to send, as (name, frame) pairs
+       self.pending_config = None
+       self.setup_frames = deque()
+
+       # a command taken from the queue whose frame did not fit in the
+       # sketch's receive buffer yet. It goes out before any other.
+       self.held_command = None
+
+       # acknowledgements that were bad, missing or late
+       self.ack_failures = 0
+
+       # when the last reply arrived, for link time accounting
+       self.last_reply = 0.0
+
+       # a flag to provide special PWM pin processing affected by the
+       # servo and tone libraries provided by Arduino. It is kept per
+       # board, since only the board that got the servo or tone command
+       # is affected.
+       self.piezo_or_servo = False
+
+       # True from the moment the latency budget ran out until the
+       # command queue is empty again
+       self.draining = False
+
+       # counters for the /metrics page: the time from writing a frame
+       # to matching its reply, and the values received per reporter
+       self.round_trips = {Request.READ: metrics.Histogram(),
+                           Request.ACK: metrics.Histogram()}
+       self.reporter_samples = dict.fromkeys( \
+                                 self.templates.reporter_map.values(), 0)
+
+       # the stage times of acknowledged commands, over the last
+       # LatencyWindow commands of each name, optionally logged one line
+       # per command to TraceLog
+       command_queue = self.config.command_queue
+       self.command_latencies = command_trace.CommandLatencies( \
+                                            command_queue.latency_window, \
+                                            command_queue.trace_log)
+
+       # watches the link for stalls. The last command sent to every
+       # output pin is kept, so that it can be sent again after the
+       # board was reset by opening the port again.
+       self.supervisor = link_supervisor.LinkSupervisor(self.config)
+       self.last_outputs = {}
+
+       self.__read_polling_options()
 
        threading.Thread.__init__(self)
        
@@ -67,6 +140,86 @@ class ArduinoTranslator(threading.Thread):
        # the thread dies cleanly and we exit back to the shell
        self.daemon = True
 
+   def __read_polling_options(self):
+       """
+       This method takes the options that control polling and command
+       processing from the configuration, so that run() does not have to.
+       It is called again when the binary protocol is agreed on and when
+       the configuration is reloaded.
+       """
+       config = self.config
+       polling = config.polling
+       command_queue = config.command_queue
+
+       # the frames that are actually sent, binary records if the sketch
+       # has agreed to the binary protocol. The poll requests are
+       # rendered once, up front.
+       if self.arduino.binary_protocol:
+           self.frames = binary_codec.BinaryTemplates(self.templates)
+           # there is no readMany record, the binary reads are small enough
+           self.poll_frames = self.frames.poll_frames
+       else:
+           self.frames = self.templates
+           self.poll_frames = self.templates.poll_frames
+
+       # this is a workaround for Tone and Servo libraries affecting PWM
+       # operation of certain pins
+       self.special_led_processing = config.special_led_processing
+       
+       # the number of read requests that may be outstanding at the
+       # Arduino at any one time. 1 is the classic stop and wait polling.
+       self.poll_window = polling.poll_window
+
+       # how often, in seconds, to print the achieved poll rates. 0 is never.
+       self.rate_report_interval = polling.rate_report_interval
+
+       # instead of one request per reporter, a single readMany request can
+       # fetch all of them with one combined reply. Too many reporters for
+       # one frame take several.
+       if polling.bulk_read and len(self.poll_frames) and \
+          not self.arduino.binary_protocol:
+           read_many_frames = self.templates.read_many_frames
+           if len(read_many_frames) == 1:
+               self.poll_frames = [("all", read_many_frames[0])]
+           else:
+               self.poll_frames = [("all%d" % (index + 1), frame) for \
+                                   index, frame in \
+                                   enumerate(read_many_frames)]
+           self.arduino.max_line_length = max( \
+                                    self.arduino.max_line_length, \
+                                    self.templates.read_many_reply_length)
+
+       # decides how many pending commands are sent between poll replies
+       self.drain_policy = drain_policy.DrainPolicy(config)
+
+       # the number of commands that may be waiting for their "{}" at
+       # once, and the bytes that may be on their way to the sketch
+       self.window.read_limit = self.poll_window
+       self.window.ack_limit = command_queue.ack_window
+       self.window.byte_limit = self.templates.rx_buffer_size
+
+       # how long, in seconds, to wait for a reply before giving up on it
+       self.reply_timeout = polling.reply_timeout
+       self.ack_timeout = command_queue.ack_timeout
+
+       # json or binary. binary is only used if the sketch agrees to it.
+       self.protocol = config.serial.protocol
+
+       self.supervisor.configure(config)
+
+       self.__build_scheduler()
+
+   def __build_scheduler(self):
+       """
+       This method sets up the poll scheduler for the current poll frames.
+       Each reporter is polled at its own target rate, if it has one.
+       """
+       rates = {}
+       for pin, label in self.templates.poll_labels.items():
+           if label in self.templates.reporter_poll_rates:
+               rates[pin] = self.templates.reporter_poll_rates[label]
+       self.scheduler = poll_scheduler.PollScheduler(self.poll_frames, rates)
+
    # test if arduino json client is responding
 
    def is_arduino_ready(self):
@@ -80,66 +233,105 @@ class ArduinoTranslator(threading.Thread):
            decoded = json.loads(self.arduino.read_line())
            arduino_status = decoded["status"]
            if arduino_status == "ready":
-               self.__initialize_pin_io()
+               self.__set_up_board()
+               self.__add_reporters()
+               self.supervisor.heard(time.monotonic())
                return True
            else:
                return False
           
-   def __initialize_pin_io(self):
+   def __negotiate_binary_protocol(self):
+       """
+       This method asks the sketch to switch to the binary protocol.
+       Sketches that do not know about it do not answer, in which case
+       JSON is used as before.
+       """
+       self.arduino.write("{\"query\":\"binary\"}")
+       reply = self.arduino.read_line(time.monotonic() + self.reply_timeout)
+       try:
+           agreed = json.loads(reply)["protocol"] == "binary"
+       except (TypeError, ValueError, KeyError):
+           agreed = False
+       if not agreed:
+           print("Arduino sketch does not support the binary protocol, " \
+                 "using JSON")
+           return
+
+       self.arduino.binary_protocol = True
+       self.__read_polling_options()
+       print("Using the binary protocol")
+
+   def __set_up_board(self, timeout=None):
+       """
+       This method agrees on the protocol and sets up the pin modes and
+       initial output values of a board that has answered the status
+       query. timeout is how long to wait for each "{}", None is forever.
+       """
+       # the batch is sent in JSON, before any switch to binary
+       pins_set = self.config.serial.batched_init and \
+           self.__batched_init()
+       if self.protocol == "binary":
+           self.__negotiate_binary_protocol()
+       self.__initialize_pin_io(pins_set, timeout)
+
+   def __batched_init(self):
+       """
+       This method sends all of the pin modes and initial output values
+       in one frame. Sketches that do not know about it do not answer.
+
+       return: True if the sketch acknowledged the frame
+       """
+       self.arduino.write(self.templates.init_frame)
+       reply = self.arduino.read_line(time.monotonic() + self.reply_timeout)
+       if self.arduino.is_ack(reply):
+           return True
+       print("Arduino sketch does not support batched initialization, " \
+             "setting up the pins one at a time")
+       return False
+
+   def __initialize_pin_io(self, pins_set=False, timeout=None):
        """
        This method establishes pin mode (INPUT or OUTPUT) 
-       and initial values for output pin.
+       and initial values for output pin, unless pins_set says that
+       the batched init frame already did.
        """
-       Config = configparser.ConfigParser()
-       Config.read(self.config_file)
- 
-       # read in the configuration file to setup pin direction
-       arduino_pin_directions_dict = dict(Config.items("ArduinoPinDirection"))
-       
+       if not pins_set:
+           # the pin direction frames were rendered from the configuration
+           # file when the templates were compiled
+           for pin_direction in self.frames.pin_direction_frames:
+              self.arduino.send_command(pin_direction, \
+                                        self.__deadline(timeout))
 
-       for pin, mode in list(arduino_pin_directions_dict.items()):
-          pin_direction = Config.get("JsonStringTemplateSection", \
-                                                     "setPinDirection") 
-          pin_direction = pin_direction.replace("PIN", pin)
-          pin_direction = pin_direction.replace("MODE", mode)
-          self.arduino.send_command(pin_direction)
-                                                       
-
-       #initialize output pin values
-       Config = configparser.ConfigParser()
-       Config.read(self.config_file)
-        
-       #build a translator dictionary for the reporter items going
-       #back to Scratch
-       arduino_init_output_pin_values_dict = \
-                       dict(Config.items("ArduinoInitialOutputPinValues"))
-       
-       for pin, type_value in list(arduino_init_output_pin_values_dict.items()):
-           initial_pin_out_value = Config.get("JsonStringTemplateSection", \
-                                                         "writeValueToPin")
-           index = type_value.find(',')
-           type = type_value[0:index]
-           value = type_value[index+1:]
-           initial_pin_out_value = initial_pin_out_value.replace("PIN", \
-                                                                  pin)
-           initial_pin_out_value = initial_pin_out_value.replace("TYPE",\
-                                                                  type)
-           initial_pin_out_value = initial_pin_out_value.replace("VALUE", \
-                                                                  value)
-           self.arduino.send_command(initial_pin_out_value)
+           #initialize output pin values
+           for initial_pin_out_value in self.frames.initial_output_frames:
+               self.arduino.send_command(initial_pin_out_value, \
+                                         self.__deadline(timeout))
+
+   def __deadline(self, timeout):
+       """
+       return: the time.monotonic() deadline timeout seconds from now, or
+               None if timeout is None
+       """
+       if timeout is None:
+           return None
+       return time.monotonic() + timeout
 
+   def __add_reporters(self):
+       """
+       This method puts every reporter into the reporter store
+       """
         # build the translation dictionary for polling
-       self.reporter_map = dict(Config.items("ReporterMapSection"))
+       self.reporter_map = self.templates.reporter_map
        for pin, scratch_label in list(self.reporter_map.items()):
-           self.scratch_reporter_dict[scratch_label] = 0
-
+           self.reporter_store.add(scratch_label, 0, \
+                         self.templates.reporter_deadbands.get(scratch_label))
             
    # thread to continuously gather poll data
 
    def run(self):
        """
        This is the thread that continuously queries Arduino sensors,
-       safely (with a thread lock), stores the values in the reporter map
+       stores the values in the reporter store
        and look to see if Scratch has issued any actuator commands passed in
        through the deque.
        
@@ -149,140 +341,450 @@ class ArduinoTranslator(threading.Thread):
        in the configuration file.
        """
 
-       Config = configparser.ConfigParser()
-       Config.read(self.config_file)
-       reporter_pin_to_type_dict = dict(Config.items("ReporterPinToTypeMap"))
-       
-       # this is a workaround for Tone and Servo libraries affecting PWM
-       # operation of certain pins
+       next_rate_report = time.monotonic() + self.rate_report_interval
 
-       special_led_processing = Config.get("SpecialProcessing", 
-                                           "enable_special_LED_processing")
-       
-       if special_led_processing == "True":
-           special_led_processing = True
-       elif special_led_processing == "False":           
-           special_led_processing = False 
-       # in case user typed in the incorrect value in the config file
-       # force it to True
-       else:                                    
-           special_led_processing = True
-       
-       # if there is nothing to report, just look for incoming commands
-       # otherwise just keep on pollin'
        while True:
-         # if we have things to report, then report then
-         if len(reporter_pin_to_type_dict):
-           for element in itertools.cycle(list(reporter_pin_to_type_dict.items())):
-             read_reporter_data = Config.get("JsonStringTemplateSection", \
-                                                             "readPinValue") 
-             pin = element[0]
-
-             type = element[1]
-             if pin == "encoder":
-                 read_reporter_data = read_reporter_data.replace( \
-                                                        "\"pin\":PIN", \
-                                                        "\"encoder\":100")
-             else:
-                 read_reporter_data = read_reporter_data.replace("PIN", \
-                                                                   pin)
-                                                                   
-             read_reporter_data = read_reporter_data.replace("TYPE", \
-                                                                   type)                                                                   
-
-             # serialize the json reply string so we can parse out
-             # the juicy bits
-             try:
-                 jreply = json.loads(self.arduino.get_data(read_reporter_data))
-             except Exception:
-                 raise
-
-             # the info we want is in the pinValue json object
-             jpinval = jreply["pinValue"]
-             
-             #parse out the pinValue object for pin and value
-             r_pin = str(jpinval["pin"])
-             r_value = str(jpinval["value"])
-             scratch_type = self.reporter_map[r_pin]
-             
-             # now update the scratch reporting dictionary with the latest
-             # value for this item
-             self.reporter_lock.acquire(True)
-             self.scratch_reporter_dict[scratch_type] = r_value
-             self.reporter_lock.release()
-             self.do_command(special_led_processing)
-         # else nothing to report so just look for commands
-         else:
-             self.do_command(special_led_processing)
-         
+           now = time.monotonic()
+           try:
+               self.fill_window(now)
+
+               if len(self.window):
+                   # wait for the reply to the oldest outstanding frame
+                   self.take_reply(self.arduino.read_reply( \
+                                                   self.window.deadline()))
+               else:
+                   # nothing is due yet and nothing is waiting to be sent,
+                   # so rest until the next request is due
+                   time.sleep(self.idle_time(now))
+           except EOFError:
+               # an overlong reply was thrown away. The request it
+               # answered times out, but the Arduino was heard from.
+               self.supervisor.heard(time.monotonic())
+           except (OSError, LinkError) as error:
+               self.recover(error)
+
+           if self.rate_report_interval and now >= next_rate_report:
+               next_rate_report = now + self.rate_report_interval
+               self.print_rate_report()
+
+   def recover(self, error):
+       """
+       This method brings the link back after the serial port failed or
+       the Arduino stopped answering. The port is opened again, after a
+       growing delay, until the sketch answers the status query. Opening
+       the port resets the board, so the pin modes and initial outputs
+       are set up again and the last command sent to every output is
+       repeated. Scratch is told that the reporters are stale meanwhile.
+
+       This blocks until the link is back. The asyncio runtime runs it
+       in an executor.
+       """
+       supervisor = self.supervisor
+       port_id = self.arduino.port_id
+       supervisor.link_down(time.monotonic())
+       print("ArduinoTranslator: lost the link to %s (%s), reconnecting" % \
+             (port_id, error))
+       self.reporter_store.set_problem(port_id, \
+                                "Arduino on %s is not responding" % (port_id))
+
+       for ack_error in self.window.clear():
+           self.report_ack_error(ack_error)
+       # the whole board is set up again, which covers any changes a
+       # reload left to be sent. The reset also detaches the servo and
+       # tone libraries, until a replayed output attaches them again.
+       self.setup_frames.clear()
+       self.piezo_or_servo = False
+
+       for delay in supervisor.delays():
+           time.sleep(delay)
+           try:
+               self.arduino.reopen()
+               # back to the JSON frames until binary is agreed on again
+               self.__read_polling_options()
+               if self.__handshake():
+                   self.__set_up_board(self.ack_timeout)
+                   self.__replay_outputs()
+                   break
+               print("ArduinoTranslator: no answer from %s" % (port_id))
+           except (OSError, EOFError, ValueError, AckError) as error:
+               print("ArduinoTranslator: cannot reconnect to %s (%s)" % \
+                     (port_id, error))
 
-                 
-   def do_command(self, special_led_processing):
+       seconds = supervisor.link_up(time.monotonic())
+       self.reporter_store.set_problem(port_id, None)
+       print("ArduinoTranslator: the link to %s is back after %.1f " \
+             "seconds" % (port_id, seconds))
+
+   def __handshake(self):
+       """
+       This method sends the status query, again every
+       status_query_time seconds, until the sketch answers it. A board
+       that was just reset ignores everything until the sketch runs.
+
+       return: True if the sketch is ready
+       """
+       deadline = time.monotonic() + self.handshake_time
+       while time.monotonic() < deadline:
+           self.arduino.write("{\"query\":\"status\"}")
+           query_deadline = min(deadline, \
+                                time.monotonic() + self.status_query_time)
+           reply = self.arduino.read_line(query_deadline)
+           while reply is not None:
+               try:
+                   return json.loads(reply)["status"] == "ready"
+               except (ValueError, KeyError, TypeError):
+                   # whatever was on its way before the reset
+                   reply = self.arduino.read_line(query_deadline)
+       return False
+
+   def __replay_outputs(self):
+       """
+       This method sends the last command of every output again
+       """
+       for command in list(self.last_outputs.values()):
+           try:
+               frame = self.command_frame(command, \
+                                          self.special_led_processing)
+           except (ValueError, KeyError):
+               # taken away by a reload
+               continue
+           self.arduino.send_command(frame, time.monotonic() + \
+                                     self.command_ack_timeout(command))
+
+   def __remember_output(self, command):
+       """
+       This method keeps a command that was sent as the last one of its
+       output pin. A tone is over once it has played, so it is not kept.
+       """
+       name = command[0]
+       if name == "piezo_tone":
+           return
+       command_frame = self.templates.commands.get(name)
+       pin = command_frame.pin if command_frame is not None else name
+       self.last_outputs[pin] = command
+
+   def reload(self, config):
+       """
+       This method hands the translator a new S2AConfig. It is taken up
+       by fill_window() as soon as no reply is outstanding, so every
+       reply is matched against the maps its request was sent with.
+       The serial port settings and the protocol are not changed.
+       """
+       self.pending_config = config
+
+   def __apply_config(self):
+       """
+       This method switches to the configuration handed over by
+       reload(). Only the pin modes and output values that differ from
+       the old configuration are sent to the Arduino.
+       """
+       old_templates = self.templates
+       self.config = self.pending_config
+       self.pending_config = None
+       self.templates = command_templates.CommandTemplates(self.config)
+       self.__read_polling_options()
+
+       templates = self.templates
+       old_modes = dict(old_templates.pin_directions)
+       for (pin, mode), frame in zip(templates.pin_directions, \
+                                     self.frames.pin_direction_frames):
+           if old_modes.get(pin) != mode:
+               self.setup_frames.append(("mode of pin %s" % (pin), frame))
+
+       old_outputs = dict((pin, (pin_type, value)) for pin, pin_type, value
+                          in old_templates.initial_output_values)
+       for (pin, pin_type, value), frame in zip( \
+                                     templates.initial_output_values, \
+                                     self.frames.initial_output_frames):
+           if old_outputs.get(pin) != (pin_type, value):
+               self.setup_frames.append(("output of pin %s" % (pin), frame))
+
+       # reporters that are gone are taken out of the poll reply, new
+       # ones start out at 0 like they do at startup
+       self.reporter_map = templates.reporter_map
+       old_labels = set(old_templates.reporter_map.values())
+       labels = list(templates.reporter_map.values())
+       for label in old_labels.difference(labels):
+           self.reporter_store.remove(label)
+           self.reporter_samples.pop(label, None)
+       for label in labels:
+           deadband = templates.reporter_deadbands.get(label)
+           if label not in old_labels:
+               self.reporter_store.add(label, 0, deadband)
+               self.reporter_samples[label] = 0
+           elif deadband != old_templates.reporter_deadbands.get(label):
+               self.reporter_store.set_deadband(label, deadband)
+
+   def fill_window(self, now):
+       """
+       This method writes as many commands as the drain policy allows and
+       as many due poll requests as the request window has room for.
+       Nothing here waits for the Arduino.
+       """
+       window = self.window
+
+       # a reloaded configuration waits until nothing is outstanding,
+       # and nothing new is sent in the meantime
+       if self.pending_config is not None:
+           if len(window):
+               return
+           self.__apply_config()
+
+       # pin modes and outputs changed by a reload go out before any
+       # command
+       while self.setup_frames and window.ack_room() and \
+             window.fits(len(self.setup_frames[0][1])):
+           name, frame = self.setup_frames.popleft()
+           self.arduino.write(frame)
+           window.add(Request.ACK, name, now, self.ack_timeout, \
+                      size=len(frame))
+
+       # the drain policy decides how many commands go out now. When the
+       # link is idle anyway, there is no reason to hold any back. Once
+       # the latency budget is used up, every pending command goes out
+       # as fast as the AckWindow allows.
+       if self.drain_policy.over_budget(self.command_deque, now):
+           self.draining = True
+       send = self.drain_policy.commands_to_send(self.command_deque, now)
+       if self.held_command is not None:
+           send += 1
+       if not len(window) and self.command_deque:
+           send = max(send, 1)
+       while send and window.ack_room() and \
+             (self.held_command is not None or self.command_deque):
+           if self.held_command is not None:
+               command = self.held_command
+               self.held_command = None
+           else:
+               command = self.command_deque.popleft()
+           trace = command_trace.trace_of(command)
+           if trace is not None and trace.dequeued is None:
+               trace.dequeued = time.monotonic()
+           try:
+               frame = self.command_frame(command, \
+                                          self.special_led_processing)
+           except (ValueError, KeyError):
+               # a binary record can refuse a value, and a reload can
+               # take away a command that was already queued
+               print("ArduinoTranslator: cannot send %s" % (command,))
+               continue
+           if not window.fits(len(frame)):
+               # wait for replies to make room in the receive buffer
+               self.held_command = command
+               break
+           self.arduino.write(frame)
+           self.__remember_output(command)
+           if trace is not None:
+               trace.written = time.monotonic()
+           window.add(Request.ACK, command[0], now, \
+                      self.command_ack_timeout(command), trace, len(frame))
+           send -= 1
+
+       # polling only resumes once a budget drain has emptied the queue
+       if self.draining:
+           if self.command_deque or self.held_command is not None:
+               return
+           self.draining = False
+
+       # top up the window with the poll requests that are due. A busy
+       # sketch, such as one moving a servo or playing a tone, takes no
+       # bytes off the line until it acknowledges the command, so no
+       # reads are sent while any acknowledgement is outstanding.
+       while window.read_room() and not window.acks and \
+             self.held_command is None:
+           poll = self.scheduler.peek(now)
+           if poll is None or not window.fits(len(poll[1])):
+               break
+           pin, read_reporter_data = self.scheduler.next_poll(now)
+           self.arduino.write(read_reporter_data)
+           window.add(Request.READ, pin, now, self.reply_timeout, \
+                      size=len(read_reporter_data))
+
+       # a link with nothing to poll gets a heartbeat now and then, so
+       # that an Arduino that has gone away is noticed
+       if not len(window) and self.supervisor.heartbeat_due(now):
+           self.arduino.write(self.frames.heartbeat_frame)
+           self.supervisor.sent(now)
+           window.add(Request.READ, self.HEARTBEAT, now, self.reply_timeout)
+
+   def take_reply(self, reply):
+       """
+       This method matches a reply, or the lack of one if reply is None,
+       to the outstanding frames. Acknowledgement problems are reported
+       and counted, but do not stop the translator.
+       """
+       window = self.window
+       now = time.monotonic()
+       if reply is None:
+           errors = window.expire(now)
+           request = None
+       elif self.arduino.is_ack(reply):
+           request, errors = window.match(Request.ACK)
+           if request is not None and request.trace is not None:
+               request.trace.acked = now
+               self.command_latencies.record(request.name, request.trace)
+       elif self.is_pin_value(reply):
+           request, errors = window.match(Request.READ)
+           try:
+               # the heartbeat only has to be answered
+               if request is None or request.name != self.HEARTBEAT:
+                   self.process_reply(reply)
+           except (ValueError, KeyError):
+               print("ArduinoTranslator: could not use reply %s" % (reply))
+       else:
+           # a reply that is neither "{}" nor a pin value
+           request = None
+           errors = []
+           if len(window) and window.requests[0].kind == Request.ACK:
+               bad = window.pop()
+               errors.append(BadAckError("bad reply %s for %s" % \
+                                         (reply, bad.name), bad.name, reply))
+           else:
+               print("ArduinoTranslator: unexpected reply %s" % (reply))
+
+       # account for the link time this reply took
+       if request is not None:
+           self.round_trips[request.kind].observe(now - request.sent)
+           elapsed = now - max(request.sent, self.last_reply)
+           if request.kind == Request.ACK:
+               self.drain_policy.record_command(elapsed)
+           else:
+               self.drain_policy.record_poll(elapsed)
+       self.last_reply = now
+
+       for error in errors:
+           self.report_ack_error(error)
+
+       # nothing at all coming back means that the link has stalled
+       if reply is None:
+           self.supervisor.check(now)
+       else:
+           self.supervisor.heard(now)
+
+   def is_pin_value(self, reply):
+       """
+       This method tells if a reply carries reporter values
+       """
+       if self.arduino.binary_protocol:
+           return reply[0] == binary_codec.PIN_VALUE
+       return "pinValue" in reply
+
+   def report_ack_error(self, error):
+       """
+       This method reports an acknowledgement problem
+       """
+       self.ack_failures += 1
+       print("ArduinoTranslator: %s" % (error))
+
+   def command_ack_timeout(self, command):
+       """
+       This method returns how long to wait for the "{}" of a command.
+       The sketch plays a tone to the end, and moves the servo with about
+       700 ms of delays, before it acknowledges them.
+       """
+       if command[0] == "piezo_tone":
+           try:
+               return self.ack_timeout + float(command[2]) / 1000.0
+           except ValueError:
+               return self.ack_timeout
+       if command[0] == "servo_degrees":
+           return self.ack_timeout + 0.7
+       return self.ack_timeout
+
+   def idle_time(self, now):
+       """
+       This method returns how long to rest when nothing is outstanding
+       """
+       if not len(self.scheduler):
+           return 0.005
+       return min(self.scheduler.time_until_due(now), 0.005)
+
+   def print_rate_report(self):
+       """
+       This method prints the achieved poll rate of every reporter next
+       to its target rate
+       """
+       print("Poll rates (target / achieved, polls per second):")
+       for pin, (target, achieved) in sorted( \
+                                   self.scheduler.rate_report().items()):
+           label = self.templates.poll_labels.get(pin, pin)
+           if target:
+               print("    %-12s %8.1f / %8.1f" % (label, target, achieved))
+           else:
+               print("    %-12s      max / %8.1f" % (label, achieved))
+
+       latencies = self.command_latencies.report()
+       if latencies:
+           print("Command latency (median / 95th percentile, ms):")
+           for line in latencies:
+               print(line)
+
+   def process_reply(self, reply):
+       """
+       This method stores the value of a pinValue reply in the reporter
+       dictionary. The reporter is found by the pin field of the reply,
+       not by the order in which requests were sent.
+
+       A pinValues reply to a readMany request updates every reporter it
+       lists with a single lock acquisition.
+
+       A binary reply is an already decoded (opcode, pin, type, value,
+       param) record.
+       """
+       samples = self.reporter_samples
+       if self.arduino.binary_protocol:
+           scratch_type = self.reporter_map[str(reply[1])]
+           samples[scratch_type] += 1
+           self.reporter_store.update(scratch_type, reply[3])
+           return
+
+       # the fixed layout of a pinValue reply is picked apart without
+       # json.loads. Anything else is parsed as JSON, just once.
+       pin_value, jreply = reply_parser.parse_reply(reply)
+       if pin_value is None:
+           updates = [(self.reporter_map[r_pin], r_value)
+                      for r_pin, r_value in jreply["pinValues"].items()]
+           for scratch_type, r_value in updates:
+               samples[scratch_type] += 1
+           self.reporter_store.update_many(updates)
+           return
+
+       #parse out the pinValue object for pin and value
+       r_type, r_pin, r_value = pin_value
+       scratch_type = self.reporter_map[r_pin]
+       samples[scratch_type] += 1
+
+       # now update the reporter store with the latest value for this item.
+       # It only takes its lock if the value has meaningfully changed.
+       self.reporter_store.update(scratch_type, r_value)
+
+   def command_frame(self, command, special_led_processing):
      """
-     This method processes Scratch commands. It checks to see if
-     any special processing is necessary as a result of calls to 
-     Tone or Servo
+     This method translates a Scratch command into the frame that is
+     sent to the Arduino
      """
-     # check to see if there is a command to send
-     if self.command_deque:
-              
-         # get the command
-         command = self.command_deque.popleft()
-         Config = configparser.ConfigParser()
-         Config.read(self.config_file)
-    
-         command_pin_map_dict  =  \
-                     dict(Config.items("CommandPinMapSection"))                        
-         
-         # handle the special case commands
-         
-         # handle a Tone request
-         if command[0] == "piezo_tone":
-             ArduinoTranslator.piezo_or_servo = True
-             cmd_string = Config.get("JsonStringTemplateSection", \
-                                     "writePiezo")
-             cmd_string = cmd_string.replace("FREQ", str(command[1]))
-             cmd_string = cmd_string.replace("TIME", str(command[2]))
-             
-         #handle a servo request
-         elif command[0] == "servo_degrees":
-             ArduinoTranslator.piezo_or_servo = True
-             cmd_string = Config.get("JsonStringTemplateSection", \
-                                     "writeServo")
-             cmd_string =cmd_string.replace("VALUE", str(command[1]))
-         # now the default cases
-         else:
-             cmd_string = Config.get("JsonStringTemplateSection", \
-                                     "writeValueToPin") 
-             
-             # here is the workaround for CodeShield LED PWM
-             # control.  
-             if ArduinoTranslator.piezo_or_servo and special_led_processing:
-                 if str(command[1]) != "0":
-                     cmd_string = cmd_string.replace("VALUE", \
-                                               "1")
-                 else:
-                     cmd_string = cmd_string.replace("VALUE", \
-                                               "0") 
-             else:                         
-                 cmd_string = cmd_string.replace("VALUE", \
-                                               str(command[1]))
-             # retieve pin and type from the table to complete
-             # the cmd_string
-             cmd_descriptor = command_pin_map_dict.get(command[0])
-             cmd_elements = cmd_descriptor.split(',')
-             
-             # element 0 = pin
-             # element 1 (not used here) is the number of parameters
-             # element 2 = type
-             cmd_string = cmd_string.replace("PIN", \
-                                     str(cmd_elements[0]))
-             if ArduinoTranslator.piezo_or_servo and special_led_processing:
-                 cmd_string = cmd_string.replace("TYPE", "digital")
-             else:
-                 cmd_string = cmd_string.replace("TYPE", \
-                                     str(cmd_elements[2]))
-             
-         #send the command string to the Arduino for processing 
-         self.arduino.send_command(cmd_string) 
+     # handle the special case commands
 
+     # handle a Tone request
+     if command[0] == "piezo_tone":
+         self.piezo_or_servo = True
+         return self.frames.write_piezo.render(FREQ=command[1], \
+                                               TIME=command[2])
+
+     #handle a servo request
+     elif command[0] == "servo_degrees":
+         self.piezo_or_servo = True
+         return self.frames.write_servo.render(VALUE=command[1])
+
+     # now the default cases
+     # pin and type were bound when the command map was compiled
+     cmd_frame = self.frames.commands[command[0]]
+
+     # here is the workaround for CodeShield LED PWM
+     # control.  
+     if self.piezo_or_servo and special_led_processing:
+         if str(command[1]) != "0":
+             return cmd_frame.digital_write.render(VALUE="1")
+         else:
+             return cmd_frame.digital_write.render(VALUE="0")
+     return cmd_frame.write.render(VALUE=command[1])
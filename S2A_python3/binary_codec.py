@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+The compact binary protocol spoken by S2AjsonClient once the host has
+asked for it with {"query":"binary"}.
+
+Every message, in both directions, is one fixed size record:
+
+    byte  0     SYNC (0xA5)
+    byte  1     opcode
+    byte  2     pin
+    byte  3     type, or mode for MODE
+    bytes 4-7   value, signed, most significant byte first
+    bytes 8-9   param, unsigned, most significant byte first
+    byte  10    checksum, the sum of bytes 1 to 9, modulo 256
+
+A piezo write carries the frequency in value and the duration in param.
+"""
+
+import struct
+
+
+SYNC = 0xA5
+
+# host to Arduino
+READ = 0x01
+WRITE = 0x02
+MODE = 0x03
+
+# Arduino to host
+PIN_VALUE = 0x81
+ACK = 0x82
+
+# the type numbers are the ones the sketch uses internally
+TYPES = {"digital": 1, "analog": 2, "piezo": 3, "servo": 4, "encoder": 5}
+TYPE_NAMES = dict((number, name) for name, number in TYPES.items())
+
+MODES = {"input": 1, "output": 2}
+MODE_NAMES = dict((number, name) for name, number in MODES.items())
+
+# everything but the checksum
+record = struct.Struct(">BBBBiH")
+RECORD_SIZE = record.size + 1
+
+
+def encode(opcode, pin=0, pin_type=0, value=0, param=0):
+    """
+    Build one record
+
+    return: the record as bytes. Raises ValueError if a field does not
+            fit.
+    """
+    try:
+        body = record.pack(SYNC, opcode, pin, pin_type, value, param)
+    except struct.error as error:
+        raise ValueError("binary record field out of range: %s" % (error))
+    return body + bytes(((sum(body) - SYNC) & 0xFF,))
+
+
+def decode(data):
+    """
+    Take apart one record
+
+    return: (opcode, pin, type, value, param). Raises ValueError if the
+            record is damaged.
+    """
+    if len(data) != RECORD_SIZE or data[0] != SYNC:
+        raise ValueError("not a binary record")
+    if (sum(data[1:-1]) & 0xFF) != data[-1]:
+        raise ValueError("binary record checksum mismatch")
+    return record.unpack_from(data)[1:]
+
+
+def next_record(buffer):
+    """
+    Take the next good record out of a bytearray. Bytes in front of a
+    SYNC byte, and records with a bad checksum, are thrown away so the
+    stream gets back in step by itself.
+
+    return: (opcode, pin, type, value, param) or None if no complete
+            record has arrived
+    """
+    while True:
+        start = buffer.find(SYNC)
+        if start < 0:
+            del buffer[:]
+            return None
+        del buffer[:start]
+        if len(buffer) < RECORD_SIZE:
+            return None
+        try:
+            decoded = decode(bytes(buffer[:RECORD_SIZE]))
+        except ValueError:
+            # a SYNC byte in the middle of a damaged record, look past it
+            del buffer[:1]
+            continue
+        del buffer[:RECORD_SIZE]
+        return decoded
+
+
+class BinaryTemplate:
+    """
+    The binary counterpart of a command_templates.JsonTemplate, with its
+    opcode, pin and type already bound. render() takes the same CAPS
+    placeholders.
+    """
+    def __init__(self, opcode, pin=0, pin_type=0):
+        self.opcode = opcode
+        self.pin = int(pin)
+        self.pin_type = pin_type
+
+    def render(self, VALUE=0, FREQ=None, TIME=0):
+        """
+        return: the record as bytes. Raises ValueError if a value is not
+                a number or does not fit.
+        """
+        if FREQ is not None:
+            VALUE = FREQ
+        # the sketch rounds the JSON numbers it is given the same way
+        return encode(self.opcode, self.pin, self.pin_type,
+                      int(float(VALUE) + 0.5), int(float(TIME) + 0.5))
+
+
+class BinaryCommandFrame:
+    """
+    The binary counterpart of a command_templates.CommandFrame
+    """
+    def __init__(self, frame):
+        self.name = frame.name
+        self.pin = frame.pin
+        self.num_params = frame.num_params
+        self.pin_type = frame.pin_type
+        # piezo_tone and servo_degrees are listed with a type of None,
+        # they have templates of their own
+        self.write = BinaryTemplate(WRITE, frame.pin,
+                                    TYPES.get(frame.pin_type, 0))
+        self.digital_write = BinaryTemplate(WRITE, frame.pin,
+                                            TYPES["digital"])
+
+
+class BinaryTemplates:
+    """
+    This class renders the frames of a command_templates.CommandTemplates
+    as binary records. It has the same attributes the translator uses, so
+    either one can be handed to it.
+    """
+    def __init__(self, templates):
+        """
+        templates is the CommandTemplates compiled from the configuration
+        file
+        """
+        self.write_piezo = BinaryTemplate(WRITE, 0, TYPES["piezo"])
+        self.write_servo = BinaryTemplate(WRITE, 5, TYPES["servo"])
+
+        self.commands = {}
+        for name, frame in templates.commands.items():
+            self.commands[name] = BinaryCommandFrame(frame)
+
+        # the encoder is read by its reported pin number
+        self.poll_frames = []
+        for pin, pin_type in templates.reporter_pins:
+            if pin == "encoder":
+                frame = encode(READ, int(templates.encoder_pin),
+                               TYPES["encoder"])
+            else:
+                frame = encode(READ, int(pin), TYPES[pin_type])
+            self.poll_frames.append((pin, frame))
+
+        self.heartbeat_frame = encode(READ, int(templates.encoder_pin),
+                                      TYPES["encoder"])
+
+        self.pin_direction_frames = [encode(MODE, int(pin), MODES[mode])
+                                     for pin, mode in templates.pin_directions]
+
+        self.initial_output_frames = [
+            encode(WRITE, int(pin), TYPES[pin_type], int(value))
+            for pin, pin_type, value in templates.initial_output_values]
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import os
+import sys
+import tty
+import json
+import math
+import time
+import queue
+import random
+import threading
+import binary_codec
+
+
+class S2AjsonClientEmulator:
+    """
+    This class is a Python model of the message handling in the
+    S2AjsonClient Arduino sketch.
+
+    Bytes written by the host are fed in, complete JSON objects are
+    framed out of them the same way the sketch's read_json() does, and
+    the replies the sketch would send are handed back as bytes.
+    Messages the sketch would silently ignore get no reply here either.
+
+    After {"query":"binary"} it speaks the binary protocol of
+    binary_codec, until a '{' turns up where a record should start.
+    """
+
+    # the sketch always reports the encoder as pin 14 (A0)
+    encoder_pin = 14
+
+    # how long, in seconds, the sketch on a 16 MHz board is busy with a
+    # message: parsing a JSON frame, per frame and per character, or
+    # checking a binary record, plus the time its actions take
+    json_frame_time = 0.0002
+    json_byte_time = 0.000005
+    record_time = 0.00005
+    analog_read_time = 0.000112
+    # the delays in the sketch's servo handling
+    servo_time = 0.7
+
+    def __init__(self):
+        """
+        Start out with every pin low and the encoder at zero
+        """
+        # pin number -> "input" or "output"
+        self.pin_modes = {}
+
+        # pin number -> last value written, or the simulated sensor value
+        self.pin_values = {}
+
+        self.encoder_position = 0
+        self.servo_position = 0
+
+        # (frequency, duration) of every tone that was played
+        self.tones = []
+
+        # bytes received that do not yet make up a complete JSON object
+        self.receive_buffer = bytearray()
+
+        # True once the host has switched to binary records
+        self.binary_protocol = False
+
+        # the processing time of the message being handled, in seconds
+        self.busy_time = 0.0
+
+    def set_input(self, pin, value):
+        """
+        Set the value that a read of the pin will report
+        """
+        self.pin_values[int(pin)] = value
+
+    def feed(self, data):
+        """
+        Accept bytes written by the host
+
+        return: a list of reply lines, as bytes, in the order the sketch
+                would send them
+        """
+        replies = []
+        for busy_time, message_replies in self.feed_timed(data):
+            replies.extend(message_replies)
+        return replies
+
+    def feed_timed(self, data):
+        """
+        Accept bytes written by the host
+
+        return: a list of (processing time in seconds, list of replies),
+                one for every complete message, in order
+        """
+        self.receive_buffer += data
+        messages = []
+        while True:
+            self.busy_time = 0.0
+            if self.binary_protocol:
+                record = self.next_record()
+                if record is not None:
+                    reply = self.handle_record(record)
+                    messages.append((self.record_time + self.busy_time,
+                                     [reply] if reply is not None else []))
+                    continue
+                if self.binary_protocol:
+                    break
+            frame = self.next_frame()
+            if frame is None:
+                break
+            replies = self.handle_frame(frame)
+            messages.append((self.json_frame_time + self.busy_time +
+                             len(frame) * self.json_byte_time, replies))
+        return messages
+
+    def next_record(self):
+        """
+        Take the next binary record out of the receive buffer. A '{'
+        ahead of the next SYNC byte means the host has gone back to JSON.
+
+        return: the decoded record, or None
+        """
+        buffer = self.receive_buffer
+        for index in range(len(buffer)):
+            if buffer[index] == ord('{'):
+                del buffer[:index]
+                self.binary_protocol = False
+                return None
+            if buffer[index] == binary_codec.SYNC:
+                del buffer[:index]
+                return binary_codec.next_record(buffer)
+        del buffer[:]
+        return None
+
+    def handle_record(self, record):
+        """
+        Run one binary record. Writes and mode changes are handed to the
+        JSON handlers, so both protocols behave the same.
+
+        return: the reply record or None
+        """
+        opcode, pin, pin_type, value, param = record
+        type_name = binary_codec.TYPE_NAMES.get(pin_type)
+        if opcode == binary_codec.READ:
+            if type_name == "encoder":
+                return binary_codec.encode(binary_codec.PIN_VALUE, pin,
+                                           pin_type, self.encoder_position)
+            if type_name not in ("digital", "analog"):
+                return None
+            return binary_codec.encode(binary_codec.PIN_VALUE, pin, pin_type,
+                                       self.read_pin(pin, type_name))
+        if opcode == binary_codec.WRITE:
+            if type_name == "piezo":
+                reply = self.run_write({"type": type_name, "freq": value,
+                                        "time": param})
+            else:
+                reply = self.run_write({"pin": pin, "type": type_name,
+                                        "value": value})
+        elif opcode == binary_codec.MODE:
+            reply = self.run_mode({"pin": pin,
+                                   "mode": binary_codec.MODE_NAMES.get(
+                                       pin_type)})
+        else:
+            reply = None
+        if reply is None:
+            return None
+        return binary_codec.encode(binary_codec.ACK, pin, pin_type)
+
+    def next_frame(self):
+        """
+        Take the next complete JSON object out of the receive buffer.
+        Anything in front of the opening brace is discarded, just like
+        the sketch does.
+
+        return: the frame, or None if there is no complete frame yet
+        """
+        buffer = self.receive_buffer
+        start = buffer.find(b'{')
+        if start < 0:
+            del buffer[:]
+            return None
+        del buffer[:start]
+
+        nested_count = 0
+        in_quote = False
+        in_escape = False
+        for index in range(len(buffer)):
+            this_value = buffer[index]
+            if in_quote:
+                if in_escape:
+                    in_escape = False
+                elif this_value == ord('"'):
+                    in_quote = False
+                elif this_value == ord('\\'):
+                    in_escape = True
+            elif this_value == ord('{'):
+                nested_count += 1
+            elif this_value == ord('}'):
+                nested_count -= 1
+                if nested_count == 0:
+                    frame = bytes(buffer[:index + 1])
+                    del buffer[:index + 1]
+                    return frame
+            elif this_value == ord('"'):
+                in_quote = True
+        return None
+
+    def handle_frame(self, frame):
+        """
+        Run every top level "name":value pair of a frame
+
+        return: a list of reply lines
+        """
+        try:
+            message = json.loads(frame.decode('utf-8'))
+        except ValueError:
+            return []
+        replies = []
+        for name, value in message.items():
+            handler = self.handlers.get(name)
+            if handler is not None:
+                try:
+                    reply = handler(self, value)
+                except (TypeError, ValueError):
+                    # malformed values are ignored by the sketch
+                    reply = None
+                if reply is not None:
+                    replies.append(reply)
+        return replies
+
+    def read_pin(self, pin, pin_type):
+        """
+        return: the value digitalRead() or analogRead() would give
+        """
+        value = self.pin_values.get(pin, 0)
+        if pin_type == "digital":
+            return 1 if value else 0
+        self.busy_time += self.analog_read_time
+        return value
+
+    def run_read(self, value):
+        """
+        {"read":{"pin":4,"type":"analog"}} or
+        {"read":{"encoder":100,"type":"analog"}}
+        """
+        if not isinstance(value, dict):
+            return None
+        if "encoder" in value:
+            return ('{"pinValue":{"type":"encoder","pin":%d,"value":%d}}\n' %
+                    (self.encoder_pin, self.encoder_position)).encode()
+        pin = value.get("pin", -1)
+        pin_type = value.get("type")
+        if pin < 0 or pin_type not in ("digital", "analog"):
+            return None
+        return ('{"pinValue":{"type":"%s", "pin":%d, "value":%d}}\n' %
+                (pin_type, pin, self.read_pin(pin, pin_type))).encode()
+
+    def run_read_many(self, value):
+        """
+        {"readMany":{"digital":[12,13],"analog":[16,17],"encoder":14}}
+        """
+        if not isinstance(value, dict):
+            return None
+        members = []
+        for name, pins in value.items():
+            if name == "encoder":
+                members.append('"%d":%d' % (pins, self.encoder_position))
+            elif name in ("digital", "analog") and isinstance(pins, list):
+                for pin in pins:
+                    members.append('"%d":%d' %
+                                   (pin, self.read_pin(pin, name)))
+        return ('{"pinValues":{%s}}\n' % ','.join(members)).encode()
+
+    def run_write(self, value):
+        """
+        {"write":{"pin":4,"type":"digital","value":1}}
+        {"write":{"type":"piezo","freq":440,"time":1000}}
+        {"write":{"type":"servo","value":90, "pin":5}}
+        """
+        if not isinstance(value, dict):
+            return None
+        # the sketch stores "time" in the pin and "freq" in the value
+        pin = int(value.get("pin", value.get("time", -1)))
+        pin_value = int(value.get("value", value.get("freq", -1)) + 0.5)
+        pin_type = value.get("type")
+        if pin <= 0 or pin_value < 0:
+            return None
+        if pin_type == "digital":
+            if pin_value not in (0, 1):
+                return None
+            self.pin_values[pin] = pin_value
+        elif pin_type == "analog":
+            if pin_value > 255:
+                return None
+            self.pin_values[pin] = pin_value
+        elif pin_type == "piezo":
+            self.tones.append((pin_value, pin))
+            # the tone is played to the end before the reply
+            self.busy_time += pin / 1000.0
+        elif pin_type == "servo":
+            self.servo_position = pin_value
+            self.busy_time += self.servo_time
+        else:
+            return None
+        return b'{}\n'
+
+    def run_mode(self, value):
+        """
+        {"mode":{"pin":1,"mode":"input"}}
+        """
+        if not isinstance(value, dict):
+            return None
+        pin = int(value.get("pin", -1) + 0.5)
+        mode = value.get("mode")
+        if pin <= 0 or mode not in ("input", "output"):
+            return None
+        self.pin_modes[pin] = mode
+        return b'{}\n'
+
+    def run_init(self, value):
+        """
+        {"init":{"input":[12,13],"output":[2,6],"digital":[2,0],
+                 "analog":[6,32]}}
+        """
+        if not isinstance(value, dict):
+            return None
+        success = True
+        for name, numbers in value.items():
+            if name not in ("input", "output", "digital", "analog") or \
+                    not isinstance(numbers, list):
+                success = False
+                continue
+            numbers = [int(number + 0.5) for number in numbers]
+            if name in ("input", "output"):
+                for pin in numbers:
+                    if pin <= 0:
+                        success = False
+                    else:
+                        self.pin_modes[pin] = name
+                continue
+            if len(numbers) % 2:
+                # a pin without a value
+                success = False
+            # the sketch writes the same way run_write does
+            for pin, pin_value in zip(numbers[0::2], numbers[1::2]):
+                if pin <= 0 or pin_value < 0 or \
+                        pin_value > (1 if name == "digital" else 255):
+                    success = False
+                else:
+                    self.pin_values[pin] = pin_value
+        return b'{}\n' if success else None
+
+    def run_query(self, value):
+        """
+        {"query":"status"} or {"query":"binary"}
+        """
+        if value == "status":
+            # the sketch uses println here, so this line ends in \r\n
+            return b'{"status":"ready"}\r\n'
+        if value == "binary":
+            self.binary_protocol = True
+            return b'{"protocol":"binary"}\n'
+        return None
+
+    # top level message names, as matched by the sketch's run_command()
+    handlers = {"read": run_read,
+                "readMany": run_read_many,
+                "write": run_write,
+                "mode": run_mode,
+                "init": run_init,
+                "query": run_query}
+
+
+class PtyBoard:
+    """
+    This class puts an S2AjsonClientEmulator behind a pseudo-terminal,
+    so that an unmodified ArduinoSerial can open it by path, and gives
+    it the timing of a real board:
+
+    - every byte takes 10 bit times on the wire, in both directions
+    - the sketch handles one message at a time, taking the emulator's
+      processing time for it, and answers only when it is done
+    - while it waits for input, the sketch only looks at the serial port
+      once a millisecond
+    - bytes that arrive while the sketch is busy wait in a 64 byte
+      receive buffer, and whatever does not fit is lost
+
+    Pseudo-terminals are only available on POSIX systems.
+    """
+
+    # the size of the Arduino's serial receive buffer
+    rx_buffer_size = 64
+
+    # how often the idle sketch checks for input
+    idle_tick = 0.001
+
+    def __init__(self, baud_rate=115200, emulator=None):
+        """
+        Open the pseudo-terminal. Call start() to bring the board up.
+        """
+        self.baud_rate = baud_rate
+        self.byte_time = 10.0 / baud_rate
+        if emulator is None:
+            emulator = S2AjsonClientEmulator()
+        self.emulator = emulator
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        self.slave = slave
+
+        # chunks of (arrival time, bytes) on their way to the sketch
+        self.received = queue.Queue()
+        # replies on their way to the host
+        self.replies = queue.Queue()
+
+        self.lock = threading.Lock()
+        # bytes in the receive buffer, not yet taken by the sketch
+        self.rx_pending = 0
+        # the time the sketch is done with the message it is handling
+        self.busy_until = 0.0
+        # bytes lost to a full receive buffer
+        self.dropped = 0
+        # (time.monotonic() time, bytes) of every chunk the host wrote
+        self.log = []
+
+    def start(self):
+        """
+        Start the threads that carry bytes in, run the sketch and carry
+        replies out
+
+        return: the path of the serial port
+        """
+        for target in (self.receive, self.run_sketch, self.transmit):
+            threading.Thread(target=target, daemon=True).start()
+        return self.path
+
+    def receive(self):
+        """
+        Move bytes written by the host onto the board's receive line
+        """
+        line_free = 0.0
+        while True:
+            data = os.read(self.master, 1024)
+            now = time.monotonic()
+            self.log.append((now, data))
+            arrival = max(now, line_free) + len(data) * self.byte_time
+            line_free = arrival
+            with self.lock:
+                if arrival < self.busy_until:
+                    # the sketch is busy, so these bytes have to fit in
+                    # the receive buffer
+                    room = max(0, self.rx_buffer_size - self.rx_pending)
+                    if len(data) > room:
+                        self.dropped += len(data) - room
+                        data = data[:room]
+                self.rx_pending += len(data)
+            if data:
+                self.received.put((arrival, data))
+
+    def run_sketch(self):
+        """
+        Hand received bytes to the emulator, one message at a time, and
+        hold every reply back until the sketch would have sent it
+        """
+        board_time = time.monotonic()
+        while True:
+            arrival, data = self.received.get()
+            with self.lock:
+                self.rx_pending -= len(data)
+            if arrival > board_time:
+                # the idle sketch only notices input on a millisecond tick
+                board_time += math.ceil((arrival - board_time) /
+                                        self.idle_tick) * self.idle_tick
+            for busy_time, replies in self.emulator.feed_timed(data):
+                board_time += busy_time
+                with self.lock:
+                    self.busy_until = board_time
+                sleep_until(board_time)
+                for reply in replies:
+                    self.replies.put(reply)
+
+    def transmit(self):
+        """
+        Send replies to the host at line speed
+        """
+        line_free = 0.0
+        while True:
+            reply = self.replies.get()
+            line_free = max(time.monotonic(), line_free) + \
+                len(reply) * self.byte_time
+            sleep_until(line_free)
+            os.write(self.master, reply)
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+def sleep_until(deadline):
+    """
+    Sleep until the time.monotonic() deadline
+    """
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+if __name__ == "__main__":
+    # run a CodeShield-like board until Ctrl-C. Point ComPort at the
+    # path that is printed.
+    #     python board_emulator.py [baud rate]
+    baud_rate = 115200
+    if len(sys.argv) == 2:
+        baud_rate = int(sys.argv[1])
+    board = PtyBoard(baud_rate)
+    print("Emulated S2AjsonClient board at %s, %d baud" %
+          (board.start(), baud_rate))
+    try:
+        while True:
+            # let the sensors wander
+            for pin in (12, 13):
+                board.emulator.set_input(pin, random.randint(0, 1))
+            for pin in (16, 17, 18, 19):
+                board.emulator.set_input(pin, random.randint(0, 1023))
+            board.emulator.encoder_position += random.randint(-1, 1)
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        print("dropped %d bytes" % (board.dropped))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import os
+import arduino_serial
+import arduino_translator
+import command_queue
+import reporter_store
+import s2a_config
+
+
+class Board:
+    """
+    One Arduino: its serial port, its queue of pending commands and the
+    translator that polls it
+    """
+    def __init__(self, config, reporter_store):
+        """
+        config is the S2AConfig of the board. Nothing is opened here.
+        Call open() to open the serial port and set up the translator.
+        """
+        self.config = config
+        self.config_file = config.config_file
+        self.reporter_store = reporter_store
+        self.commands = command_queue.CommandQueue(config)
+        self.arduino = arduino_serial.ArduinoSerial(config)
+        self.translator = None
+
+    def open(self):
+        """
+        Open the serial port and create the translator for this board.
+        The boards of a profile share its reporter store.
+        """
+        self.arduino.open()
+        self.translator = arduino_translator.ArduinoTranslator( \
+                                                     self.arduino, \
+                                                     self.reporter_store, \
+                                                     self.commands, \
+                                                     self.config)
+
+    def reload(self, config):
+        """
+        Hand a reloaded S2AConfig to the command queue and the translator
+        of this board
+        """
+        self.config = config
+        self.commands.reload(config)
+        self.translator.reload(config)
+
+    def command_names(self):
+        return list(self.config.commands)
+
+    def reporter_labels(self):
+        return list(self.config.reporter_map.values())
+
+
+class CommandRouter:
+    """
+    This class takes the place of the command queue for the Scratch side
+    when there is more than one board. Each command is appended to the
+    queue of the board that has it in its [CommandPinMapSection].
+    """
+    def __init__(self, boards):
+        """
+        boards is the list of opened Boards. If two boards use the same
+        command name, the first one gets it.
+        """
+        self.boards = boards
+        self.route()
+
+    def route(self):
+        """
+        Work out which board gets which command. This is done again when
+        the configuration is reloaded.
+        """
+        routes = {}
+        for board in self.boards:
+            for name in board.command_names():
+                routes.setdefault(name, board)
+        self.routes = routes
+
+    def append(self, command):
+        """
+        Raises KeyError if no board has the command, which can happen
+        for a moment while the configuration is being reloaded
+        """
+        # the queue is looked up on every call, so that a board's queue
+        # can be wrapped after the router was built
+        self.routes[command[0]].commands.append(command)
+
+    def __len__(self):
+        return sum(len(board.commands) for board in self.boards)
+
+
+class BoardPool:
+    """
+    This class hands out one Board per serial port, so that profiles that
+    drive the same Arduino share its serial port and translator
+    """
+    def __init__(self):
+        # serial port -> Board
+        self.boards = {}
+
+    def board(self, config, store):
+        """
+        Get the Board for the serial port of config, an S2AConfig. A
+        board that is already in use by another profile publishes its
+        reporters to store as well. Raises ValueError if the two profiles
+        set the board up with different configuration files.
+
+        return: the Board
+        """
+        port = config.serial.com_port
+        board = self.boards.get(port)
+        if board is None:
+            board = Board(config, store)
+            self.boards[port] = board
+            return board
+
+        if os.path.abspath(board.config_file) != \
+           os.path.abspath(config.config_file):
+            raise ValueError("%s is set up by both %s and %s" %
+                             (port, board.config_file, config.config_file))
+        if not isinstance(board.reporter_store,
+                          reporter_store.ReporterStoreGroup):
+            board.reporter_store = reporter_store.ReporterStoreGroup(
+                [board.reporter_store])
+        board.reporter_store.stores.append(store)
+        return board
+
+    def all_boards(self):
+        return list(self.boards.values())
+
+
+class Profile:
+    """
+    One configuration file, served to Scratch on its own HTTP port with
+    its own reporters and commands
+    """
+    def __init__(self, config, pool):
+        """
+        config is an S2AConfig, or the name of a configuration file. The
+        boards of the profile are taken from pool. The command router is
+        set up by open_router() once the boards are open.
+
+        Raises ValueError, or s2a_config.ConfigError, if the profile
+        cannot be set up.
+        """
+        self.config = s2a_config.load(config)
+        self.config_file = self.config.config_file
+        if self.config.http.port is None:
+            raise s2a_config.ConfigError("%s: [HTTPServerSection] PORT: "
+                                         "missing" % (self.config_file))
+        self.reporter_store = reporter_store.ReporterStore()
+        self.boards = [pool.board(board_config, self.reporter_store)
+                       for board_config in
+                       s2a_config.board_configs(self.config)]
+        self.command_router = None
+
+        # the GetHandler class that serves this profile, once there is one
+        self.handler = None
+
+    def open_router(self):
+        self.command_router = CommandRouter(self.boards)
+        return self.command_router
+
+    def reload(self, config):
+        """
+        Switch the boards, the command router and the HTTP handler of
+        this profile over to a reloaded S2AConfig. It must set up the
+        same boards on the same serial ports.
+        """
+        self.config = config
+        for board, board_config in zip(self.boards,
+                                       s2a_config.board_configs(config)):
+            board.reload(board_config)
+        report_name_clashes(self.boards)
+        # the handler stops accepting dropped commands before the router
+        # forgets where they went
+        if self.handler is not None:
+            self.handler.set_config(config)
+        self.command_router.route()
+
+
+def report_name_clashes(boards):
+    """
+    Scratch sees the commands and reporters of every board in one
+    namespace, so a name used by more than one board is reported here.
+
+    return: True if there were no clashes
+    """
+    clean = True
+    for kind, names_of in (("command", Board.command_names),
+                           ("reporter", Board.reporter_labels)):
+        owner = {}
+        for board in boards:
+            for name in names_of(board):
+                if name in owner:
+                    print("The %s %s is used by both %s and %s" %
+                          (kind, name, owner[name], board.config_file))
+                    clean = False
+                else:
+                    owner[name] = board.config_file
+    return clean
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import time
+import threading
+import itertools
+from collections import OrderedDict
+import command_trace
+import s2a_config
+
+
+class CommandQueueFull(Exception):
+    """
+    A command was turned away because the queue of its board is full
+    """
+
+
+class CommandQueue:
+    """
+    This class passes commands from Scratch to the Arduino side.
+
+    It is used like the deque it replaces: Scratch appends on the right
+    and the Arduino side pops from the left. The difference is that only
+    the latest value of a command for a pin is kept. When a Scratch
+    slider sends a stream of values faster than the Arduino can take
+    them, the values that were overtaken before they could be sent are
+    simply dropped.
+
+    A command that is replaced moves to the back of the queue, so the
+    commands that are sent still follow the order in which their final
+    values arrived. One-shot commands, such as piezo_tone, are never
+    merged, since every one of them matters.
+
+    The queue can be limited to MaxQueueDepth commands, so that a flood
+    of commands cannot make memory and latency grow without bound. What
+    happens to a command that finds it full is up to the OverflowPolicy.
+    """
+
+    def __init__(self, config):
+        """
+        Take the command to pin map and the list of one-shot commands
+        from config, an S2AConfig or the name of a configuration file
+        """
+        self.reload(config)
+
+        # (command name, pin) -> (latest command, time it was queued),
+        # oldest first
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+        # gives every one-shot command a key of its own
+        self.one_shot_sequence = itertools.count()
+
+        # the number of commands dropped because a newer value replaced
+        # them, dropped to make room, and turned away by a full queue
+        self.coalesced = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def reload(self, config):
+        """
+        Take up a new command to pin map, list of one-shot commands and
+        queue limit. Commands that are already queued stay where they
+        are.
+        """
+        config = s2a_config.load(config)
+
+        # command name -> pin
+        self.command_pins = dict((name, spec.pin) for name, spec in
+                                 config.commands.items())
+
+        self.one_shot_commands = config.command_queue.one_shot_commands
+
+        # 0 is no limit
+        self.max_depth = config.command_queue.max_depth
+        self.overflow = config.command_queue.overflow
+
+    def key(self, command):
+        """
+        return: the key under which a command is queued
+        """
+        name = command[0]
+        if name in self.one_shot_commands:
+            return (name, next(self.one_shot_sequence))
+        return (name, self.command_pins.get(name))
+
+    def append(self, command):
+        """
+        Queue a split Scratch command, replacing any value still waiting
+        to be sent for the same command and pin
+
+        Raises CommandQueueFull if the queue is full and the overflow
+        policy does not make room.
+        """
+        key = self.key(command)
+        trace = command_trace.trace_of(command)
+        with self.lock:
+            if key in self.pending:
+                del self.pending[key]
+                self.coalesced += 1
+            elif self.max_depth and len(self.pending) >= self.max_depth:
+                self.make_room(key)
+            queued = time.monotonic()
+            self.pending[key] = (command, queued)
+        if trace is not None:
+            trace.enqueued = queued
+
+    def make_room(self, key):
+        """
+        Apply the overflow policy to a full queue for a command to be
+        queued under key. The caller must hold the lock.
+        """
+        pending = self.pending
+        if self.overflow == "drop_oldest":
+            # a lowered limit is caught up with here as well
+            while len(pending) >= self.max_depth:
+                pending.popitem(last=False)
+                self.dropped += 1
+            return
+        if self.overflow == "drop_oldest_same_pin":
+            pin = self.command_pins.get(key[0])
+            for queued_key in pending:
+                if self.command_pins.get(queued_key[0]) == pin:
+                    del pending[queued_key]
+                    self.dropped += 1
+                    return
+        self.rejected += 1
+        raise CommandQueueFull("%d commands are waiting to be sent" %
+                               (len(pending)))
+
+    def popleft(self):
+        """
+        return: the oldest pending command
+
+        Raises IndexError if there is none, just like a deque.
+        """
+        with self.lock:
+            if not self.pending:
+                raise IndexError("pop from an empty CommandQueue")
+            return self.pending.popitem(last=False)[1][0]
+
+    def oldest_age(self, now=None):
+        """
+        return: how long, in seconds, the oldest pending command has been
+                waiting, or 0 if nothing is pending
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if not self.pending:
+                return 0.0
+            command, queued = next(iter(self.pending.values()))
+        return now - queued
+
+    def __len__(self):
+        return len(self.pending)
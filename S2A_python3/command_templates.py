@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import re
+import json
+import s2a_config
+
+
+class JsonTemplate:
+    """
+    A single entry of [JsonStringTemplateSection] compiled into its
+    literal text and its CAPS placeholders.
+
+    The template string is only parsed once. Frames are produced by
+    gluing pre-encoded literal bytes around the placeholder values,
+    so no string searching or replacing happens at run time.
+    """
+
+    # the placeholders that may appear in a template
+    placeholder_pattern = re.compile(r'\b(PIN|TYPE|VALUE|MODE|FREQ|TIME)\b')
+
+    def __init__(self, literals, fields):
+        """
+        literals is a list of strings, one more than the number of fields.
+        fields is a list of placeholder names found between the literals.
+        """
+        self.literals = [literal.encode('utf8') for literal in literals]
+        self.fields = tuple(fields)
+
+        # a fully bound template is nothing but a ready to send frame
+        if not self.fields:
+            self.frame = self.literals[0]
+        else:
+            self.frame = None
+
+    @classmethod
+    def compile(cls, template):
+        """
+        Split a template string such as
+        {"mode":{"pin":PIN,"mode":"MODE"}} into literals and fields
+        """
+        pieces = cls.placeholder_pattern.split(template)
+        # split() alternates literal, field, literal, ... literal
+        return cls(pieces[0::2], pieces[1::2])
+
+    def bind(self, **values):
+        """
+        Substitute some of the placeholders now and return a new,
+        smaller template for the ones that are left.
+        """
+        literals = [self.literals[0].decode('utf8')]
+        fields = []
+        for index, field in enumerate(self.fields):
+            following = self.literals[index + 1].decode('utf8')
+            if field in values:
+                literals[-1] += str(values[field]) + following
+            else:
+                fields.append(field)
+                literals.append(following)
+        return JsonTemplate(literals, fields)
+
+    def render(self, **values):
+        """
+        Fill in all of the remaining placeholders
+
+        return: the frame as bytes, ready to be written to the Arduino
+        """
+        if self.frame is not None:
+            return self.frame
+        literals = self.literals
+        frame = literals[0]
+        for index, field in enumerate(self.fields):
+            frame += str(values[field]).encode('utf8') + literals[index + 1]
+        return frame
+
+
+class CommandFrame:
+    """
+    The precompiled writeValueToPin template for one entry of
+    [CommandPinMapSection], with its pin and type already bound.
+    """
+    def __init__(self, name, pin, num_params, pin_type, write_template):
+        self.name = name
+        self.pin = pin
+        self.num_params = num_params
+        self.pin_type = pin_type
+
+        # normal operation: only VALUE is left to fill in
+        self.write = write_template.bind(PIN=pin, TYPE=pin_type)
+
+        # CodeShield special LED processing forces a digital write
+        self.digital_write = write_template.bind(PIN=pin, TYPE="digital")
+
+
+class CommandTemplates:
+    """
+    This class compiles the template, command and reporter sections of
+    the configuration once, at startup, into frames and partially bound
+    templates.
+
+    Pins are kept as strings in here, the way the sketch reports them.
+    """
+
+    # the pin number the sketch uses when it reports the encoder
+    encoder_pin = "14"
+
+    # the size of the sketch's serial receive buffer. Whatever does not
+    # fit while the sketch is busy is lost, so no frame may be longer.
+    rx_buffer_size = 64
+
+    def __init__(self, config):
+        """
+        Compile all of the JSON related configuration sections. config is
+        an S2AConfig, or the name of a configuration file.
+        """
+        config = s2a_config.load(config)
+
+        def template(name):
+            return JsonTemplate.compile(config.templates[name])
+
+        self.write_value_to_pin = template("writeValueToPin")
+        self.set_pin_direction = template("setPinDirection")
+        self.read_pin_value = template("readPinValue")
+        self.write_servo = template("writeServo")
+        self.write_piezo = template("writePiezo")
+        self.read_encoder = template("readEncoder")
+
+        # commands coming from Scratch, keyed by command name
+        self.commands = {}
+        for name, spec in config.commands.items():
+            self.commands[name] = CommandFrame(name, str(spec.pin),
+                                               spec.num_params,
+                                               spec.pin_type,
+                                               self.write_value_to_pin)
+
+        # the pin sections are kept as well, so that frames for the
+        # binary protocol can be built from them
+        self.reporter_pins = [(str(pin), pin_type)
+                              for pin, pin_type in config.reporter_pins]
+        self.pin_directions = [(str(pin), mode)
+                               for pin, mode in config.pin_directions]
+        self.initial_output_values = [
+            (str(output.pin), output.pin_type, str(output.value))
+            for output in config.initial_outputs]
+
+        # fully rendered poll requests, one per reporter pin, in the
+        # order they appear in the configuration file
+        self.poll_frames = []
+        for pin, pin_type in self.reporter_pins:
+            if pin == "encoder":
+                frame = self.read_encoder.render(TYPE=pin_type)
+            else:
+                frame = self.read_pin_value.render(PIN=pin, TYPE=pin_type)
+            self.poll_frames.append((pin, frame))
+
+        # the heartbeat of the link supervision only has to get a reply,
+        # and reading the encoder changes nothing on the board
+        self.heartbeat_frame = self.read_encoder.render(TYPE="analog")
+
+        # readMany requests that read every reporter in as few frames as
+        # fit in the sketch's receive buffer, and the longest pinValues
+        # reply that any of them can produce
+        self.read_many_frames = []
+        reporters = []
+        for reporter in self.reporter_pins:
+            if reporters and len(self.read_many_request( \
+                    reporters + [reporter])[0]) > self.rx_buffer_size:
+                self.read_many_frames.append( \
+                    self.read_many_request(reporters)[0])
+                reporters = []
+            reporters.append(reporter)
+        if reporters:
+            self.read_many_frames.append(self.read_many_request(reporters)[0])
+        self.read_many_reply_length = \
+            self.read_many_request(self.reporter_pins)[1]
+
+        # fully rendered pin direction and initial output value frames
+        self.pin_direction_frames = []
+        for pin, mode in self.pin_directions:
+            self.pin_direction_frames.append(
+                self.set_pin_direction.render(PIN=pin, MODE=mode))
+
+        self.initial_output_frames = []
+        for pin, pin_type, value in self.initial_output_values:
+            self.initial_output_frames.append(
+                self.write_value_to_pin.render(PIN=pin, TYPE=pin_type,
+                                               VALUE=value))
+
+        # all of the pin directions and initial output values in a single
+        # frame, which the sketch acknowledges once
+        init = {}
+        for pin, mode in self.pin_directions:
+            init.setdefault(mode, []).append(int(pin))
+        for pin, pin_type, value in self.initial_output_values:
+            init.setdefault(pin_type, []).extend((int(pin), int(value)))
+        init = dict((name, init[name]) for name in
+                    ("input", "output", "digital", "analog") if name in init)
+        self.init_frame = json.dumps({"init": init},
+                                     separators=(',', ':')).encode()
+
+        # translation of the pin reported by the Arduino to a Scratch label
+        self.reporter_map = dict((str(pin), label) for pin, label in
+                                 config.reporter_map.items())
+
+        # the Scratch label of every poll request. The encoder is listed
+        # as "encoder" but reported by the sketch as encoder_pin.
+        self.poll_labels = {}
+        for pin, frame in self.poll_frames:
+            if pin == "encoder":
+                self.poll_labels[pin] = self.reporter_map.get(self.encoder_pin)
+            else:
+                self.poll_labels[pin] = self.reporter_map.get(pin)
+
+        # optional target poll rates in polls per second, and deadbands,
+        # keyed by Scratch label
+        self.reporter_poll_rates = config.reporter_poll_rates
+        self.reporter_deadbands = config.reporter_deadbands
+
+    def read_many_request(self, reporter_pins):
+        """
+        Build a readMany request for a list of (pin, type) reporter pins.
+        The sketch always reports the encoder as pin 14, so it is asked
+        for that way.
+
+        return: (the frame, the length of the longest pinValues reply it
+                can produce, allowing 11 characters for every value)
+        """
+        read_many = {}
+        reply_length = len('{"pinValues":{}}')
+        for pin, pin_type in reporter_pins:
+            if pin == "encoder":
+                pin = self.encoder_pin
+                read_many["encoder"] = int(pin)
+            else:
+                read_many.setdefault(pin_type, []).append(int(pin))
+            reply_length += len('"":,') + len(pin) + 11
+        frame = json.dumps({"readMany": read_many},
+                           separators=(',', ':')).encode()
+        return frame, reply_length
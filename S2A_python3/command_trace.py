@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Timing of Scratch commands on their way to the Arduino.
+
+Every command Scratch sends is stamped, with time.monotonic(), as it
+passes each step:
+
+    received    the HTTP GET was taken apart
+    enqueued    the command was put in the command queue
+    dequeued    the translator took it off the queue
+    written     its frame was written to the serial port
+    acked       the sketch's "{}" for it was matched
+
+The differences between these times tell whether a slow command spent
+its time in the queue, on the serial link or in the sketch.
+"""
+
+import time
+from collections import deque
+import metrics
+
+
+class CommandTrace:
+    """
+    The timestamps of one command. A step that has not happened yet is
+    None.
+    """
+    __slots__ = ("text", "received", "enqueued", "dequeued", "written",
+                 "acked")
+
+    # stage name, from step, to step
+    stages = (("handoff", "received", "enqueued"),
+              ("queue", "enqueued", "dequeued"),
+              ("send", "dequeued", "written"),
+              ("ack", "written", "acked"),
+              ("total", "received", "acked"))
+
+    def __init__(self, text, received):
+        # the command as Scratch sent it
+        self.text = text
+        self.received = received
+        self.enqueued = None
+        self.dequeued = None
+        self.written = None
+        self.acked = None
+
+
+class TracedCommand(list):
+    """
+    A split Scratch command that carries its CommandTrace. It is still
+    a list of words, so the queue and the translator can handle it like
+    any other command.
+    """
+
+    def __init__(self, words, received=None):
+        list.__init__(self, words)
+        if received is None:
+            received = time.monotonic()
+        self.trace = CommandTrace('/'.join(words), received)
+
+
+def trace_of(command):
+    """
+    return: the CommandTrace of a command, or None if it has none
+    """
+    return getattr(command, "trace", None)
+
+
+class CommandLatencies:
+    """
+    This class collects the stage times of acknowledged commands by
+    command name. It keeps a histogram of every stage for the /metrics
+    page, and the last window commands of every name for the rolling
+    report printed with the poll rates. With a trace log, every command
+    is also written there as one line of timestamps.
+    """
+
+    def __init__(self, window=100, trace_log=None):
+        """
+        trace_log is the name of a file to append to, or None
+        """
+        self.window = window
+        # (command name, stage) -> metrics.Histogram
+        self.histograms = {}
+        # command name -> deque of (stage seconds, ...) in stage order
+        self.recent = {}
+        self.trace_log = None
+        if trace_log:
+            self.trace_log = open(trace_log, "a", buffering=1)
+            if self.trace_log.tell() == 0:
+                self.trace_log.write("# command received enqueued "
+                                     "dequeued written acked\n")
+
+    def record(self, name, trace):
+        """
+        Account for a command whose acknowledgement has been matched
+        """
+        durations = []
+        for stage, start, end in CommandTrace.stages:
+            start = getattr(trace, start)
+            end = getattr(trace, end)
+            if start is None or end is None:
+                durations.append(None)
+                continue
+            seconds = end - start
+            durations.append(seconds)
+            histogram = self.histograms.get((name, stage))
+            if histogram is None:
+                histogram = self.histograms[(name, stage)] = \
+                    metrics.Histogram()
+            histogram.observe(seconds)
+
+        recent = self.recent.get(name)
+        if recent is None:
+            recent = self.recent[name] = deque(maxlen=self.window)
+        recent.append(durations)
+
+        if self.trace_log is not None:
+            self.trace_log.write("%s %s\n" % (trace.text, " ".join(
+                "-" if value is None else "%.6f" % value
+                for value in (trace.received, trace.enqueued,
+                              trace.dequeued, trace.written,
+                              trace.acked))))
+
+    def report(self):
+        """
+        return: lines giving the median and 95th percentile, in
+                milliseconds, of every stage over the last commands of
+                every name
+        """
+        lines = []
+        for name, recent in sorted(self.recent.items()):
+            columns = []
+            for index, (stage, start, end) in \
+                    enumerate(CommandTrace.stages):
+                values = sorted(durations[index] for durations in recent
+                                if durations[index] is not None)
+                if values:
+                    columns.append("%s %.1f/%.1f" % (
+                        stage, 1000.0 * percentile(values, 0.5),
+                        1000.0 * percentile(values, 0.95)))
+            lines.append("    %-16s %s" % (name, "  ".join(columns)))
+        return lines
+
+
+def percentile(values, fraction):
+    """
+    return: the value below which fraction of the sorted values lie
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Reloading of the configuration files while the extension runs.
+
+A ConfigWatcher looks at the modification times of the configuration
+files of every profile, and of the board files they list. When one of
+them has changed, and has then been left alone for one more look, so
+that a file is not read while an editor is still writing it, the
+profile's files are loaded and checked again and the
+new command map, reporter map and poll schedule are handed to the
+running translators and HTTP handler. The serial connection is left
+alone, so the Arduino is not reset and Scratch stays connected.
+
+Settings that can only be taken up by starting over, such as the serial
+and HTTP ports, are not reloaded. A file with a mistake in it is
+reported and the running configuration is kept.
+"""
+
+import os
+import time
+import threading
+import s2a_config
+
+
+def modification_time(path):
+    """
+    return: the modification time of a file, or None if it is missing
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def restart_needed(old, new):
+    """
+    Compare two S2AConfigs of the same profile
+
+    return: a description of the first setting that cannot be changed
+            without a restart, or None if there is none
+    """
+    if (old.http, old.runtime) != (new.http, new.runtime):
+        return "[HTTPServerSection] or [RuntimeSection]"
+    old_boards = s2a_config.board_configs(old)
+    new_boards = s2a_config.board_configs(new)
+    if [board.config_file for board in old_boards] != \
+       [board.config_file for board in new_boards]:
+        return "[BoardSection] Boards"
+    for old_board, new_board in zip(old_boards, new_boards):
+        if old_board.serial != new_board.serial:
+            return "[SerialPortSection] of %s" % (new_board.config_file)
+        if old_board.command_queue.trace_log != \
+           new_board.command_queue.trace_log:
+            return "[CommandQueueSection] TraceLog of %s" % \
+                (new_board.config_file)
+    return None
+
+
+class ConfigWatcher:
+    """
+    This class reloads the configuration of profiles whose files have
+    changed
+    """
+
+    def __init__(self, profiles, interval=1.0):
+        """
+        profiles is the list of running board_router.Profiles. Their files
+        are looked at every interval seconds.
+        """
+        self.profiles = profiles
+        self.interval = interval
+
+        # file name -> modification time when it was last loaded, and
+        # when it was last looked at
+        self.loaded = {}
+        for profile in profiles:
+            for path in self.files(profile):
+                self.loaded[path] = modification_time(path)
+        self.seen = dict(self.loaded)
+
+    def files(self, profile):
+        return [config.config_file
+                for config in s2a_config.board_configs(profile.config)]
+
+    def check(self):
+        """
+        Reload every profile with a file that changed since it was last
+        loaded, but not since the last check
+        """
+        for profile in self.profiles:
+            paths = self.files(profile)
+            changed = False
+            settled = True
+            for path in paths:
+                mtime = modification_time(path)
+                if mtime != self.loaded.get(path):
+                    changed = True
+                if mtime != self.seen.get(path):
+                    settled = False
+                self.seen[path] = mtime
+            if changed and settled:
+                for path in paths:
+                    self.loaded[path] = self.seen[path]
+                self.reload(profile)
+
+    def reload(self, profile):
+        """
+        Load and check the files of a profile and hand them to it
+
+        return: True if the new configuration was taken up
+        """
+        try:
+            config = s2a_config.load(profile.config_file)
+        except ValueError as error:
+            print("Configuration not reloaded: %s" % (error))
+            return False
+        setting = restart_needed(profile.config, config)
+        if setting is not None:
+            print("Configuration of %s not reloaded: a change to %s needs "
+                  "a restart" % (profile.config_file, setting))
+            return False
+        profile.reload(config)
+        print("Reloaded configuration %s" % (profile.config_file))
+        return True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def start(self):
+        """
+        Watch the files from a thread of its own
+        """
+        threading.Thread(target=self.run, daemon=True).start()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import time
+import s2a_config
+
+
+class DrainPolicy:
+    """
+    This class decides, between poll replies, how many of the pending
+    Scratch commands are sent to the Arduino.
+
+    Two rules are applied:
+
+    * latency budget: once the oldest pending command has waited
+      MaxCommandLatency milliseconds, every pending command is sent
+      before polling resumes.
+    * link share: otherwise one command is sent as long as commands have
+      used less than ActuatorLinkShare of the recent link time.
+
+    This keeps the time from an HTTP request to the pin bounded, no
+    matter how many reporters are being polled, without letting a burst
+    of commands starve the reporters.
+    """
+
+    # how much of the recent link time history is kept on every update
+    decay = 0.95
+
+    def __init__(self, config):
+        """
+        Take the policy settings of [CommandQueueSection] from config, an
+        S2AConfig or the name of a configuration file
+        """
+        command_queue = s2a_config.load(config).command_queue
+
+        # in seconds, 0 turns the latency budget off
+        self.max_latency = command_queue.max_latency
+        self.link_share = command_queue.link_share
+
+        # decaying totals of the link time spent on commands and polls
+        self.command_time = 0.0
+        self.poll_time = 0.0
+
+    def record_command(self, seconds):
+        """
+        Account for link time spent sending a command
+        """
+        self.command_time = self.command_time * self.decay + seconds
+        self.poll_time *= self.decay
+
+    def record_poll(self, seconds):
+        """
+        Account for link time spent on a poll request
+        """
+        self.poll_time = self.poll_time * self.decay + seconds
+        self.command_time *= self.decay
+
+    def over_budget(self, command_queue, now=None):
+        """
+        return: True if the oldest pending command has used up the
+                latency budget, so every pending command is to be sent
+                before polling resumes
+        """
+        if not self.max_latency or not len(command_queue):
+            return False
+        if now is None:
+            now = time.monotonic()
+        return command_queue.oldest_age(now) >= self.max_latency
+
+    def commands_to_send(self, command_queue, now=None):
+        """
+        return: the number of pending commands to send now
+        """
+        pending = len(command_queue)
+        if not pending:
+            return 0
+        if self.over_budget(command_queue, now):
+            return pending
+        total = self.command_time + self.poll_time
+        if not total or self.command_time / total < self.link_share:
+            return 1
+        return 0
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Supervision of the serial link to one Arduino.
+
+A LinkSupervisor keeps track of when the Arduino was last heard from.
+When the link has been quiet for a while a heartbeat is due, so that a
+board with nothing to poll is still noticed when it goes away, and when
+nothing at all has come back for StallTimeout seconds the link is taken
+to be stalled. The translator then opens the port again, with a delay
+that doubles after every failed attempt, and sets the board up again.
+"""
+
+import time
+import metrics
+import s2a_config
+
+
+class LinkError(Exception):
+    """
+    The Arduino has stopped answering, although the port is still open
+    """
+
+
+class LinkSupervisor:
+    """
+    This class holds the link supervision settings of [SerialPortSection]
+    and the state and counters of the link.
+    """
+
+    # upper bounds, in seconds, from a quick reopen of the port up to a
+    # cable that was plugged back in after a while
+    recovery_buckets = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, config):
+        """
+        Take the settings from config, an S2AConfig or the name of a
+        configuration file
+        """
+        self.configure(config)
+
+        # time.monotonic() times of the last reply and of the last heartbeat
+        self.last_heard = time.monotonic()
+        self.last_sent = self.last_heard
+
+        # when the link went down, or None while it is up
+        self.down_since = None
+
+        # counters for the /metrics page
+        self.failures = 0
+        self.recovery_times = metrics.Histogram(self.recovery_buckets)
+
+    def configure(self, config):
+        """
+        Take up the settings of a reloaded configuration
+        """
+        link = s2a_config.load(config).link
+        self.heartbeat_interval = link.heartbeat_interval
+        self.stall_timeout = link.stall_timeout
+        self.reconnect_delay = link.reconnect_delay
+        self.max_reconnect_delay = link.max_reconnect_delay
+
+    def sent(self, now):
+        self.last_sent = now
+
+    def heard(self, now):
+        self.last_heard = now
+
+    def heartbeat_due(self, now):
+        """
+        return: True if nothing has been heard, and no heartbeat has
+                been sent, for HeartbeatInterval seconds
+        """
+        return bool(self.heartbeat_interval) and \
+            now - max(self.last_sent, self.last_heard) >= \
+            self.heartbeat_interval
+
+    def time_until_heartbeat(self, now):
+        """
+        return: the seconds until the next heartbeat is due, or None if
+                heartbeats are turned off
+        """
+        if not self.heartbeat_interval:
+            return None
+        return max(0.0, max(self.last_sent, self.last_heard) +
+                   self.heartbeat_interval - now)
+
+    def check(self, now):
+        """
+        Called when a request has gone unanswered. Raises LinkError if
+        nothing has been heard for StallTimeout seconds.
+        """
+        quiet = now - self.last_heard
+        if self.stall_timeout and quiet >= self.stall_timeout:
+            raise LinkError("no reply for %.1f seconds" % (quiet))
+
+    def is_up(self):
+        return self.down_since is None
+
+    def link_down(self, now):
+        """
+        Start the clock on a recovery
+        """
+        self.failures += 1
+        self.down_since = now
+
+    def link_up(self, now):
+        """
+        Account for a finished recovery
+
+        return: the seconds the link was down
+        """
+        seconds = now - self.down_since
+        self.recovery_times.observe(seconds)
+        self.down_since = None
+        self.last_heard = now
+        self.last_sent = now
+        return seconds
+
+    def delays(self):
+        """
+        return: an endless iterator of the seconds to wait before each
+                attempt to open the port again
+        """
+        delay = self.reconnect_delay
+        while True:
+            yield delay
+            delay = min(delay * 2, self.max_reconnect_delay)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Counters for the /metrics page, in the Prometheus text exposition format.
+
+The translator, the serial port and the HTTP handler keep plain integer
+counters and Histograms as attributes of their own, updated where the
+work is done. Nothing is computed until the page is asked for. Rates,
+such as polls per second, are left to the scraper, for example
+rate(s2a_poll_requests_total[1m]) in Prometheus.
+"""
+
+import bisect
+import time
+
+
+# the content type of the text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """
+    A fixed bucket histogram of durations in seconds. Only the owning
+    thread calls observe(), so no lock is taken. A page rendered while
+    an observation is under way may be off by that one observation.
+    """
+
+    # upper bounds, in seconds, from a single frame at 115200 baud up to
+    # the servo's 700 ms of delays
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        # one count per bucket plus one for values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """
+        return: the exposition lines of this histogram, with cumulative
+                buckets
+        """
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(sample(name + "_bucket",
+                                labels + (("le", repr(bound)),), total))
+        total += self.counts[-1]
+        lines.append(sample(name + "_bucket", labels + (("le", "+Inf"),),
+                            total))
+        lines.append(sample(name + "_sum", labels, self.sum))
+        lines.append(sample(name + "_count", labels, total))
+        return lines
+
+
+def escape(value):
+    """
+    return: value escaped for use as a label value
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+
+def sample(name, labels, value):
+    """
+    return: one exposition line. labels is a tuple of (name, value) pairs.
+    """
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (label, escape(label_value))
+                                  for label, label_value in labels)
+    return "%s %s" % (name, value)
+
+
+class Page:
+    """
+    This class collects the metric families of one /metrics page
+    """
+
+    def __init__(self):
+        self.families = {}
+
+    def add(self, name, metric_type, help_text, labels, value):
+        """
+        Add a sample to a family. value is a number, or a Histogram for
+        a histogram family.
+        """
+        family = self.families.get(name)
+        if family is None:
+            family = ["# HELP %s %s" % (name, help_text),
+                      "# TYPE %s %s" % (name, metric_type)]
+            self.families[name] = family
+        if isinstance(value, Histogram):
+            family.extend(value.samples(name, labels))
+        else:
+            family.append(sample(name, labels, value))
+
+    def text(self):
+        lines = []
+        for family in self.families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
+
+
+def render(handler):
+    """
+    Build the /metrics page of one profile. handler is its GetHandler
+    class, which counts the Scratch polls and knows the boards through
+    its command router.
+
+    return: the page as a string
+    """
+    page = Page()
+    now = time.monotonic()
+    page.add("s2a_uptime_seconds", "gauge",
+             "Seconds since the HTTP server was set up.", (),
+             now - handler.started)
+    page.add("s2a_poll_requests_total", "counter",
+             "Scratch poll requests served.", (), handler.poll_requests)
+    page.add("s2a_stale_poll_requests_total", "counter",
+             "Scratch poll requests served while a serial link was down.",
+             (), handler.stale_polls)
+
+    for board in getattr(handler.command_deque, "boards", []):
+        arduino = board.arduino
+        translator = board.translator
+        labels = (("board", arduino.port_id),)
+
+        page.add("s2a_command_queue_depth", "gauge",
+                 "Scratch commands waiting to be sent.", labels,
+                 len(board.commands))
+        page.add("s2a_command_queue_oldest_age_seconds", "gauge",
+                 "Seconds the oldest waiting command has waited.", labels,
+                 board.commands.oldest_age(now))
+        page.add("s2a_commands_coalesced_total", "counter",
+                 "Commands replaced by a newer value before being sent.",
+                 labels, board.commands.coalesced)
+        page.add("s2a_command_queue_limit", "gauge",
+                 "Most commands that may wait to be sent, 0 for no limit.",
+                 labels, board.commands.max_depth)
+        page.add("s2a_commands_dropped_total", "counter",
+                 "Waiting commands dropped to make room in a full queue.",
+                 labels, board.commands.dropped)
+        page.add("s2a_commands_rejected_total", "counter",
+                 "Commands turned away by a full queue.", labels,
+                 board.commands.rejected)
+
+        page.add("s2a_serial_reconnects_total", "counter",
+                 "Times the serial port was opened again.", labels,
+                 arduino.reconnects)
+        page.add("s2a_read_line_overruns_total", "counter",
+                 "Replies thrown away for exceeding the line length.",
+                 labels, arduino.overruns)
+        if translator is None:
+            continue
+
+        supervisor = translator.supervisor
+        page.add("s2a_serial_link_up", "gauge",
+                 "1 while the serial link is up, 0 while it is being "
+                 "recovered.", labels, int(supervisor.is_up()))
+        page.add("s2a_serial_link_failures_total", "counter",
+                 "Times the serial link failed or stalled.", labels,
+                 supervisor.failures)
+        page.add("s2a_serial_recovery_seconds", "histogram",
+                 "Seconds from losing the serial link to having the board "
+                 "set up again.", labels, supervisor.recovery_times)
+        page.add("s2a_ack_failures_total", "counter",
+                 "Commands with a missing, bad or late acknowledgement.",
+                 labels, translator.ack_failures)
+        # the board thread adds keys to these dicts while the page is
+        # rendered, so work from copies
+        round_trips = list(translator.round_trips.items())
+        for kind, histogram in sorted(round_trips):
+            page.add("s2a_serial_round_trip_seconds", "histogram",
+                     "Seconds from writing a frame to matching its reply.",
+                     labels + (("kind", kind),), histogram)
+
+        latencies = list(translator.command_latencies.histograms.items())
+        for (name, stage), histogram in sorted(latencies):
+            page.add("s2a_command_latency_seconds", "histogram",
+                     "Seconds a command spent in each stage on its way "
+                     "to the Arduino.",
+                     labels + (("command", name), ("stage", stage)),
+                     histogram)
+
+        target_rates = dict(translator.scheduler.target_rates)
+        reporter_samples = dict(translator.reporter_samples)
+        poll_labels = list(translator.templates.poll_labels.items())
+        for pin, label in sorted(poll_labels):
+            reporter_labels = labels + (("reporter", label),)
+            page.add("s2a_reporter_samples_total", "counter",
+                     "Values received from the Arduino for a reporter.",
+                     reporter_labels,
+                     reporter_samples.get(label, 0))
+            page.add("s2a_reporter_target_rate", "gauge",
+                     "Target polls per second of a reporter, 0 for as "
+                     "fast as possible.", reporter_labels,
+                     target_rates.get(pin, 0))
+    return page.text()
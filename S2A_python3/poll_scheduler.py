@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import heapq
+import time
+
+
+class PollScheduler:
+    """
+    This class decides which reporter is polled next.
+
+    Every poll request has a target rate in polls per second. Requests
+    are kept in a min-heap ordered by the time.monotonic() time at which
+    they are next due. A rate of 0 means "as often as possible": such a
+    request is always due again right away, behind everything else that
+    is already due, so requests without a rate are polled round robin
+    with whatever link time the rate limited ones leave over.
+
+    The scheduler also counts the polls it hands out, so the achieved
+    rate of every reporter can be compared with its target.
+    """
+
+    def __init__(self, poll_frames, rates=None):
+        """
+        poll_frames is a list of (pin, frame) pairs.
+        rates maps a pin to its target rate in polls per second.
+        """
+        if rates is None:
+            rates = {}
+        now = time.monotonic()
+
+        # breaks ties between requests due at the same time, keeping
+        # them in first come, first served order
+        self.sequence = 0
+
+        # [due time, sequence, pin, frame, interval]
+        self.heap = []
+
+        # pin -> target rate, and pin -> polls handed out
+        self.target_rates = {}
+        self.poll_counts = {}
+
+        for pin, frame in poll_frames:
+            rate = rates.get(pin, 0)
+            if rate:
+                interval = 1.0 / rate
+            else:
+                interval = 0.0
+            self.target_rates[pin] = rate
+            self.poll_counts[pin] = 0
+            self.heap.append([now, self.sequence, pin, frame, interval])
+            self.sequence += 1
+        heapq.heapify(self.heap)
+
+        self.report_start = now
+
+    def __len__(self):
+        return len(self.heap)
+
+    def peek(self, now=None):
+        """
+        return: the (pin, frame) next_poll() would hand out, without
+                taking it, or None if nothing is due yet
+        """
+        if now is None:
+            now = time.monotonic()
+        heap = self.heap
+        if not heap or heap[0][0] > now:
+            return None
+        return heap[0][2], heap[0][3]
+
+    def next_poll(self, now=None):
+        """
+        Hand out the next request that is due and schedule its next turn
+
+        return: (pin, frame), or None if nothing is due yet
+        """
+        if now is None:
+            now = time.monotonic()
+        heap = self.heap
+        if not heap or heap[0][0] > now:
+            return None
+        entry = heapq.heappop(heap)
+        due, sequence, pin, frame, interval = entry
+
+        if interval:
+            # stay on the target rate, but do not try to catch up on
+            # polls that were missed while the link was busy
+            entry[0] = max(due + interval, now)
+        else:
+            entry[0] = now
+        entry[1] = self.sequence
+        self.sequence += 1
+        heapq.heappush(heap, entry)
+
+        self.poll_counts[pin] += 1
+        return pin, frame
+
+    def time_until_due(self, now=None):
+        """
+        return: seconds until the next request is due, 0 if one is due
+        """
+        if not self.heap:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self.heap[0][0] - now)
+
+    def rate_report(self):
+        """
+        Compare the achieved poll rate of every request with its target
+        since the previous report, and start counting afresh.
+
+        return: a dictionary of pin -> (target rate, achieved rate)
+        """
+        now = time.monotonic()
+        elapsed = max(now - self.report_start, 1e-9)
+        report = {}
+        for pin, count in self.poll_counts.items():
+            report[pin] = (self.target_rates[pin], count / elapsed)
+            self.poll_counts[pin] = 0
+        self.report_start = now
+        return report
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+A decoder for the pinValue replies of S2AjsonClient.
+
+The sketch prints these replies with a fixed layout, for example
+{"pinValue":{"type":"analog", "pin":16, "value":512}} or, for the
+encoder, {"pinValue":{"type":"encoder","pin":14,"value":-3}}, so the
+three fields can be picked out with one precompiled pattern instead of
+building a dictionary with json.loads. Anything that does not have
+exactly that layout is handed to json.loads, once, and the dictionary
+it makes is handed back for replies such as pinValues.
+
+Run this file to compare the two:
+
+    python reply_parser.py
+"""
+
+import re
+import json
+import timeit
+
+
+# the layout the sketch prints, with or without the spaces it puts
+# after the commas
+pin_value_pattern = re.compile(r'\{"pinValue":\{"type":"(\w+)", ?'
+                               r'"pin":(\d+), ?"value":(-?\d+)\}\}\s*\Z')
+
+
+def parse_pin_value(reply):
+    """
+    Pick the fields out of a pinValue reply
+
+    return: (type, pin as a string, value as an int), or None if the
+            reply is not a pinValue reply. Raises ValueError or KeyError
+            if it is not valid JSON either.
+    """
+    return parse_reply(reply)[0]
+
+
+def parse_reply(reply):
+    """
+    Pick the fields out of a pinValue reply, or parse any other reply as
+    JSON
+
+    return: (pinValue fields, None) for a pinValue reply in the fixed
+            layout, (pinValue fields or None, dictionary) for anything
+            that had to go through json.loads. Raises ValueError or
+            KeyError if the reply is not valid JSON either.
+    """
+    match = pin_value_pattern.match(reply)
+    if match is not None:
+        return (match.group(1), match.group(2), int(match.group(3))), None
+    jreply = json.loads(reply)
+    return pin_value_fields(jreply), jreply
+
+
+def json_pin_value(reply):
+    """
+    Pick the fields out of any JSON reply with json.loads
+
+    return: (type, pin as a string, value), or None if the reply is not
+            a pinValue reply
+    """
+    return pin_value_fields(json.loads(reply))
+
+
+def pin_value_fields(jreply):
+    """
+    return: (type, pin as a string, value) of a reply that json.loads
+            has parsed, or None if it is not a pinValue reply
+    """
+    if "pinValue" not in jreply:
+        return None
+    jpinval = jreply["pinValue"]
+    return jpinval.get("type"), str(jpinval["pin"]), jpinval["value"]
+
+
+def benchmark(number=200000):
+    """
+    Time both decoders on the replies the sketch sends
+
+    return: a dictionary of reply -> (json.loads seconds,
+            parse_pin_value seconds) for number replies
+    """
+    replies = ['{"pinValue":{"type":"analog", "pin":16, "value":512}}',
+               '{"pinValue":{"type":"digital", "pin":12, "value":1}}',
+               '{"pinValue":{"type":"encoder","pin":14,"value":-706}}']
+    results = {}
+    for reply in replies:
+        results[reply] = (timeit.timeit(lambda: json_pin_value(reply),
+                                        number=number),
+                          timeit.timeit(lambda: parse_pin_value(reply),
+                                        number=number))
+    return results
+
+
+if __name__ == "__main__":
+    number = 200000
+    print("%d replies of each kind:" % (number))
+    for reply, (loads, parser) in benchmark(number).items():
+        print("%s\n    json.loads %.3f s, parse_pin_value %.3f s, "
+              "%.1f times faster" % (reply, loads, parser, loads / parser))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import threading
+
+
+class ReporterStore:
+    """
+    This class holds the latest value of every Scratch reporter.
+
+    The Arduino side writes values into it. Every time a value actually
+    changes, the version number is bumped and the body of the Scratch
+    poll reply is rendered again and published as a single
+    (version, body) tuple.
+
+    A reporter can be given a deadband. Its value is then only published
+    when it has moved more than the deadband away from the last
+    published value, so that noisy analog inputs flickering by a count
+    or two do not cause a new poll body every time they are sampled.
+
+    The HTTP side only ever reads that tuple. Replacing an attribute is
+    atomic, so pollers never take the writer's lock, and a poll between
+    two sensor changes costs nothing but an attribute read.
+    """
+
+    def __init__(self):
+        """
+        Start out empty. An empty store reports "okay" to Scratch.
+        """
+        # reporter label -> latest published value
+        self.values = {}
+
+        # reporter label -> smallest change that will be published
+        self.deadbands = {}
+
+        # source, such as a board's port, -> description of a problem
+        # that leaves values stale, for instance a lost serial link
+        self.problems = {}
+
+        # only one writer may change the values and render a new body
+        self.lock = threading.Lock()
+
+        # (version, encoded poll reply body)
+        self.snapshot = (0, b"okay")
+
+    def add(self, label, value=0, deadband=0):
+        """
+        Add a reporter with its initial value and deadband
+        """
+        with self.lock:
+            self.values[label] = value
+            if deadband:
+                self.deadbands[label] = deadband
+            self.publish()
+
+    def remove(self, label):
+        """
+        Take a reporter out of the poll reply
+        """
+        with self.lock:
+            self.values.pop(label, None)
+            self.deadbands.pop(label, None)
+            self.publish()
+
+    def set_deadband(self, label, deadband=0):
+        """
+        Change the deadband of a reporter. It applies from the next update.
+        """
+        with self.lock:
+            if deadband:
+                self.deadbands[label] = deadband
+            else:
+                self.deadbands.pop(label, None)
+
+    def set_problem(self, source, message=None):
+        """
+        Report a problem of one source to Scratch, which shows it as the
+        status of the extension, or clear it if message is None
+        """
+        with self.lock:
+            if message is None:
+                self.problems.pop(source, None)
+            else:
+                self.problems[source] = message
+            self.publish()
+
+    def is_stale(self):
+        """
+        return: True while a problem is reported
+        """
+        return bool(self.problems)
+
+    def changed(self, label, value):
+        """
+        return: True if value differs enough from the last published
+                value of the reporter to be published
+        """
+        last = self.values.get(label)
+        if last == value:
+            return False
+        deadband = self.deadbands.get(label)
+        if deadband:
+            try:
+                return abs(value - last) > deadband
+            except TypeError:
+                # not a number, so any change counts
+                pass
+        return True
+
+    def update(self, label, value):
+        """
+        Store the latest value of one reporter
+
+        return: True if the value was published
+        """
+        # nothing to do if the value has not really changed
+        if not self.changed(label, value):
+            return False
+        with self.lock:
+            self.values[label] = value
+            self.publish()
+        return True
+
+    def update_many(self, updates):
+        """
+        Store the latest values of several reporters at once, with a
+        single lock acquisition and at most one new poll body.
+        updates is an iterable of (label, value) pairs.
+
+        return: True if any value was published
+        """
+        changed = [(label, value) for label, value in updates
+                   if self.changed(label, value)]
+        if not changed:
+            return False
+        values = self.values
+        with self.lock:
+            for label, value in changed:
+                values[label] = value
+            self.publish()
+        return True
+
+    def publish(self):
+        """
+        Render the poll reply body for the current values and publish it
+        with the next version number. The caller must hold the lock.
+        """
+        if self.values:
+            body = "".join(["%s %s\n\r" % (label, value)
+                            for label, value in self.values.items()])
+        else:
+            body = "okay"
+        if self.problems:
+            # the _problem line of a poll reply is the extension's status
+            problem = "_problem %s\n\r" % \
+                ("; ".join(sorted(self.problems.values())))
+            body = body + problem if self.values else problem
+        self.snapshot = (self.snapshot[0] + 1, body.encode('utf-8'))
+
+    def poll_body(self):
+        """
+        return: the encoded body of the poll reply for Scratch
+        """
+        return self.snapshot[1]
+
+
+class ReporterStoreGroup:
+    """
+    This class hands reporter values on to several ReporterStores. It is
+    used in place of a ReporterStore for a board that is shared by more
+    than one configuration profile, each with its own store.
+    """
+
+    def __init__(self, stores=()):
+        self.stores = list(stores)
+
+    def add(self, label, value=0, deadband=0):
+        for store in self.stores:
+            store.add(label, value, deadband)
+
+    def remove(self, label):
+        for store in self.stores:
+            store.remove(label)
+
+    def set_deadband(self, label, deadband=0):
+        for store in self.stores:
+            store.set_deadband(label, deadband)
+
+    def set_problem(self, source, message=None):
+        for store in self.stores:
+            store.set_problem(source, message)
+
+    def update(self, label, value):
+        published = False
+        for store in self.stores:
+            published = store.update(label, value) or published
+        return published
+
+    def update_many(self, updates):
+        updates = list(updates)
+        published = False
+        for store in self.stores:
+            published = store.update_many(updates) or published
+        return published
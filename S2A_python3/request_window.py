@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+from collections import deque
+from arduino_serial import MissingAckError, LateAckError
+
+
+class Request:
+    """
+    One frame that has been written to the Arduino and is waiting for
+    its reply
+    """
+    # the two kinds of reply the sketch sends
+    READ = "read"
+    ACK = "ack"
+
+    def __init__(self, kind, name, sent, deadline, trace=None, size=0):
+        # READ or ACK
+        self.kind = kind
+        # the poll pin for a read, the command for an ack
+        self.name = name
+        # the length of the frame in bytes
+        self.size = size
+        # time.monotonic() times
+        self.sent = sent
+        self.deadline = deadline
+        # the CommandTrace of a traced command
+        self.trace = trace
+
+
+class RequestWindow:
+    """
+    This class tracks the frames that have been written to the Arduino
+    but not yet answered.
+
+    The sketch handles frames one at a time and answers them in the
+    order they arrive, so read requests and commands can both be
+    outstanding at once and their replies are matched in order. The
+    number of outstanding reads and of outstanding commands are limited
+    separately. The bytes of all outstanding frames together can be
+    limited as well, so that they fit in the sketch's receive buffer
+    while it is busy.
+
+    The sketch sends nothing at all for a frame it does not like, so a
+    reply that skips over older requests means those requests went
+    unanswered. Skipped commands, and commands whose deadline passes,
+    are reported as MissingAckError. An acknowledgement with no command
+    waiting for it is reported as LateAckError.
+    """
+
+    def __init__(self, read_limit=1, ack_limit=1, byte_limit=0):
+        self.read_limit = read_limit
+        self.ack_limit = ack_limit
+        # 0 is no limit
+        self.byte_limit = byte_limit
+        self.requests = deque()
+        self.reads = 0
+        self.acks = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def read_room(self):
+        return self.reads < self.read_limit
+
+    def ack_room(self):
+        return self.acks < self.ack_limit
+
+    def fits(self, size):
+        """
+        return: True if a frame of size bytes may be written now. An empty
+                window takes a frame of any size.
+        """
+        return not self.requests or not self.byte_limit or \
+            self.bytes + size <= self.byte_limit
+
+    def add(self, kind, name, sent, timeout, trace=None, size=0):
+        """
+        Record a frame that has just been written
+        """
+        self.requests.append(Request(kind, name, sent, sent + timeout,
+                                     trace, size))
+        self.bytes += size
+        if kind == Request.READ:
+            self.reads += 1
+        else:
+            self.acks += 1
+
+    def pop(self):
+        """
+        return: the oldest outstanding request, removed from the window
+        """
+        request = self.requests.popleft()
+        self.bytes -= request.size
+        if request.kind == Request.READ:
+            self.reads -= 1
+        else:
+            self.acks -= 1
+        return request
+
+    def clear(self):
+        """
+        Give up on every outstanding request, when the link is lost
+
+        return: list of AckErrors, one for every command among them
+        """
+        errors = []
+        while self.requests:
+            request = self.pop()
+            if request.kind == Request.ACK:
+                errors.append(MissingAckError("acknowledgement for %s lost "
+                                              "with the link" %
+                                              (request.name,),
+                                              request.name))
+        return errors
+
+    def deadline(self):
+        """
+        return: the deadline of the oldest outstanding request
+        """
+        return self.requests[0].deadline
+
+    def match(self, kind):
+        """
+        Match a reply of the given kind to the oldest outstanding request
+        of that kind. Older requests of the other kind were skipped by
+        the sketch and are dropped.
+
+        return: (the matched request or None, list of AckErrors)
+        """
+        errors = []
+        if kind == Request.ACK and not self.acks:
+            errors.append(LateAckError("acknowledgement with no command "
+                                       "outstanding", reply="{}"))
+            return None, errors
+        if kind == Request.READ and not self.reads:
+            return None, errors
+        while self.requests:
+            request = self.pop()
+            if request.kind == kind:
+                return request, errors
+            if request.kind == Request.ACK:
+                errors.append(MissingAckError("no acknowledgement for %s" %
+                                              (request.name,),
+                                              request.name))
+        return None, errors
+
+    def expire(self, now):
+        """
+        Give up on the oldest request if its deadline has passed
+
+        return: list of AckErrors
+        """
+        errors = []
+        if self.requests and self.requests[0].deadline <= now:
+            request = self.pop()
+            if request.kind == Request.ACK:
+                errors.append(MissingAckError("acknowledgement for %s "
+                                              "timed out" % (request.name,),
+                                              request.name))
+        return errors
@@ -23,11 +23,12 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
 import sys
-import threading
-from collections import deque
+import asyncio
 import arduino_serial
-import arduino_translator
 import scratch_translator
+import s2a_asyncio
+import board_router
+import config_watcher
 
 
 
@@ -44,8 +45,8 @@ class Scratch2ArduinoExtension:
                                    
         The serial port for Arduino communications is opened.
     
-        An Arduino translation object is instantiated and its
-        processing thread is started.
+        An Arduino translation object is instantiated for every board
+        and its processing thread is started.
        
         An HTTP server is instantiated and started to handle
         all communications to and from Scratch.
@@ -54,85 +55,133 @@ class Scratch2ArduinoExtension:
         the user presses CTRL-C
         """
         
-        # default config file if none specified when program invoked
-        if len(sys.argv) == 2:  
-            config_file = str(sys.argv[1])
+        # default config file if none specified when program invoked.
+        # Several configuration files may be given, each is served to
+        # Scratch on the HTTP port it sets up.
+        if len(sys.argv) >= 2:  
+            config_files = [str(arg) for arg in sys.argv[1:]]
         else:
-            config_file = "s2e.cfg"
+            config_files = ["s2e.cfg"]
             
-        print("\nUsing configuration file: %s" % config_file)
+        print("\nUsing configuration file: %s" % ", ".join(config_files))
         print("If you wish to  use another configuration file, ")
         print("specify the configuration file name on the command line.")
         print("Example:")
         print("python scratch_extension.py my_own_config_file")
-        # this is the data structure that allows the Arduino side of the 
-        # of the interface to share reporter data with the Scratch side
-        # in a safe and efficient manner        
-        scratch_reporter_dict = {}        
-        
-        #establish a lock for the reporter dictionary to make it a safe
-        # sharing data structure
-        reporter_lock =  threading.Lock()
 
-        #establish a deque for passing commands from Scratch to the 
-        #arduino
-    
-        # Scratch will append to the right side and the Arduino side of this
-        # extension will pop from the left, effectively making this a FIFO
-        # data structure. This does not need a lock to be used safely.
+        # every profile has its own reporter store. This is the data
+        # structure that allows the Arduino side of the interface to share
+        # reporter data with the Scratch side in a safe and efficient
+        # manner. It keeps the poll reply for Scratch rendered, so the
+        # Scratch side never has to wait for the Arduino side.
+
+        # every board gets its own serial port, command queue and
+        # translator. A configuration file describes its first board and
+        # may list the configuration files of more. Profiles that use the
+        # same serial port share the board.
     
-        command_deque = deque() 
-        
+        # Scratch will append to the right side of a board's command queue
+        # and the Arduino side of this extension will pop from the left,
+        # effectively making this a FIFO data structure. Only the latest
+        # value of a command for a pin is kept, so a fast Scratch slider
+        # does not build up a backlog.
+
         # we use a seperate class for serial communication in anticipation
         # of WiFi in the very near future. This should allow us to adapt
         # quckly.
-        
-        arduino = arduino_serial.ArduinoSerial(config_file)
-        
-        # open communications to the arduino
+        # every configuration file is read and checked here, before any
+        # serial port is opened
+        pool = board_router.BoardPool()
         try:
-            arduino.open()
-        except Exception:
-            print('Serial Port Open Failed:')
-            print('            is the Arduino available and plugged in ?')
+            profiles = [board_router.Profile(config_file, pool)
+                        for config_file in config_files]
+        except ValueError as error:
+            print(error)
             sys.exit(1)
-
-        # a class is used to translate commands to and from the arduino 
-        # board.
-
-        # we pass in some common data structures that it will share with the
-        # scratch side of the house. 
-        the_arduino_translator = arduino_translator.ArduinoTranslator( \
-                                                     arduino, \
-                                                     scratch_reporter_dict, \
-                                                     reporter_lock,\
-                                                     command_deque, \
-                                                     config_file)                                                 
-        # does the arduino have a responding json client available?                                                    
+        boards = pool.all_boards()
+        
+        # open communications to the arduinos
+        for board in boards:
+            try:
+                board.open()
+            except Exception:
+                print('Serial Port Open Failed: %s' % (board.arduino.port_id))
+                print('            is the Arduino available and plugged in ?')
+                sys.exit(1)
+
+        # the commands and reporters of all boards of a profile share one
+        # namespace. The Scratch side appends commands to the profile's
+        # router, and they are passed on to the board that owns them.
+        for profile in profiles:
+            board_router.report_name_clashes(profile.boards)
+            profile.open_router()
+
+        # the translators and the HTTP servers can either run as threads
+        # and blocking servers, or together on one asyncio event loop
+        runtime = profiles[0].config.runtime
+
+        # the configuration files can be watched and reloaded while the
+        # extension runs
+        watcher = None
+        if profiles[0].config.reload_interval:
+            watcher = config_watcher.ConfigWatcher(profiles, \
+                                        profiles[0].config.reload_interval)
+
+        # does each arduino have a responding json client available?                                                    
         # verify that json client is ready and then init all i/o pins                                              
-        if the_arduino_translator.is_arduino_ready():
-            # kick off the arduino thread
-            the_arduino_translator.start()  
+        for board in boards:
+            try:
+                arduino_ready = board.translator.is_arduino_ready()
+            except arduino_serial.AckError as error:
+                print('Arduino pin initialization failed on %s: %s' %
+                      (board.arduino.port_id, error))
+                sys.exit(1)
+            if not arduino_ready:
+                print('Arduino JSON client does not respond on %s' %
+                      (board.arduino.port_id))
+                sys.exit(1)
+
+        if runtime == "asyncio":
             print('Arduino interface is up and running.\n')
-        else:
-            print('Arduino JSON client does not respond')
-            sys.exit(1)
+            try:
+                asyncio.run(s2a_asyncio.run(boards, profiles, watcher))
+            except KeyboardInterrupt:
+                print("Goodbye !")
+                for board in boards:
+                    board.arduino.clean_up()
+            except Exception:
+                for board in boards:
+                    board.arduino.clean_up()
+                    board.arduino.close()
+            return
+
+        # kick off an arduino thread for each board
+        for board in boards:
+            board.translator.start()  
+        print('Arduino interface is up and running.\n')
 
         # send the initiazlization information for the scratch translator
-        # to use. This will kick off the HTTP server and then we are off to
-        # the races.
+        # to use. This will kick off the HTTP servers and then we are off
+        # to the races.
         try:                 
-            scratch_translator.start_server(scratch_reporter_dict, 
-                             reporter_lock, 
-                             command_deque,
-                             config_file)  
+            servers = [scratch_translator.make_server(profile.reporter_store,
+                                                      profile.command_router,
+                                                      profile.config)
+                       for profile in profiles]
+            for profile, server in zip(profiles, servers):
+                profile.handler = server.RequestHandlerClass
+            if watcher is not None:
+                watcher.start()
+            scratch_translator.serve_forever(servers)
         except Exception:
-            arduino.clean_up
-            arduino.close()
+            for board in boards:
+                board.arduino.clean_up()
+                board.arduino.close()
             return                               
         except KeyboardInterrupt:
             # give control back to the shell that started us
-            arduino.clean_up()
+            for board in boards:
+                board.arduino.clean_up()
             return
 
 
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import asyncio
+import functools
+import time
+import metrics
+import scratch_translator
+from link_supervisor import LinkError
+from scratch_translator import GetHandler
+
+
+class AsyncArduinoSerial:
+    """
+    This class puts an opened ArduinoSerial port under the control of an
+    asyncio event loop.
+
+    The loop watches the port's file descriptor and pulls in whatever
+    has arrived, so nothing ever blocks waiting for the Arduino. Complete
+    replies are handed to read_reply() through an asyncio.Queue.
+
+    The event loop needs to be able to watch the port, so this only works
+    on POSIX systems. While the translator recovers a lost link the port
+    is not watched, and it is attached again once it has been reopened.
+    """
+
+    def __init__(self, arduino):
+        """
+        arduino is an ArduinoSerial instance that has already been opened
+        """
+        self.arduino = arduino
+        self.replies = asyncio.Queue()
+
+    def attach(self, loop):
+        """
+        Switch the port to non-blocking reads and start watching it
+        """
+        port = self.arduino.arduino
+        port.timeout = 0
+        # replies and errors from before a reconnect are of no use
+        self.replies = asyncio.Queue()
+        self.loop = loop
+        self.fd = port.fileno()
+        loop.add_reader(self.fd, self.data_ready)
+
+    def detach(self, loop):
+        """
+        Stop watching the port
+        """
+        loop.remove_reader(self.fd)
+
+    def data_ready(self):
+        """
+        Called by the event loop when the port has data. Every complete
+        reply is queued for read_reply().
+        """
+        port = self.arduino.arduino
+        try:
+            self.arduino.read_buffer += port.read(port.in_waiting or 1)
+            while True:
+                try:
+                    reply = self.arduino.next_reply()
+                except EOFError as error:
+                    # an overlong reply was thrown away, the port itself
+                    # is fine and the replies behind it are still good
+                    self.replies.put_nowait(error)
+                    continue
+                if reply is None:
+                    break
+                self.replies.put_nowait(reply)
+        except Exception as error:
+            # let whoever is waiting for a reply see the failure. A port
+            # that has failed stays ready to read, so stop watching it.
+            self.loop.remove_reader(self.fd)
+            self.replies.put_nowait(error)
+
+    def write(self, data):
+        """
+        Write a frame to the Arduino
+        """
+        self.arduino.write(data)
+
+    async def read_reply(self):
+        """
+        Wait for the next reply from the Arduino
+
+        return: a line of data, or a decoded binary record
+        """
+        reply = await self.replies.get()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+class AsyncCommandQueue:
+    """
+    This class lets the translator coroutine sleep until Scratch sends a
+    command. It wraps a CommandQueue, so commands are coalesced the same
+    way as in the thread runtime, and sets an asyncio.Event whenever a
+    command is appended.
+    """
+
+    def __init__(self, commands):
+        """
+        commands is the CommandQueue that holds the pending commands
+        """
+        self.commands = commands
+        self.ready = asyncio.Event()
+
+    def append(self, command):
+        self.commands.append(command)
+        self.ready.set()
+
+    def popleft(self):
+        return self.commands.popleft()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def oldest_age(self, now=None):
+        return self.commands.oldest_age(now)
+
+    def reload(self, config):
+        self.commands.reload(config)
+
+    @property
+    def coalesced(self):
+        return self.commands.coalesced
+
+    @property
+    def dropped(self):
+        return self.commands.dropped
+
+    @property
+    def rejected(self):
+        return self.commands.rejected
+
+    @property
+    def max_depth(self):
+        return self.commands.max_depth
+
+    async def wait(self, timeout):
+        """
+        Wait until a command is appended or the timeout, in seconds, passes
+        """
+        if self.commands:
+            return
+        self.ready.clear()
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_translator(translator, link):
+    """
+    This coroutine does the work of ArduinoTranslator.run() on the event
+    loop. While it waits for a reply from the Arduino, the HTTP side is
+    free to run, and when there is nothing to send it sleeps until a
+    command arrives or the next poll is due instead of spinning.
+
+    A lost link is recovered by ArduinoTranslator.recover() in an
+    executor, so Scratch keeps being answered in the meantime.
+    """
+    loop = asyncio.get_running_loop()
+    commands = translator.command_deque
+    window = translator.window
+    next_rate_report = time.monotonic() + translator.rate_report_interval
+    while True:
+        now = time.monotonic()
+        try:
+            translator.fill_window(now)
+
+            if len(window):
+                # wait for the reply to the oldest outstanding frame
+                try:
+                    reply = await asyncio.wait_for(link.read_reply(),
+                                                   window.deadline() - now)
+                except asyncio.TimeoutError:
+                    reply = None
+                translator.take_reply(reply)
+            elif not translator.poll_frames:
+                # nothing to report, so just wait for commands, the next
+                # heartbeat, and a reloaded configuration, which is
+                # looked for as often as the files are
+                timeout = translator.supervisor.time_until_heartbeat(now)
+                reload_interval = translator.config.reload_interval
+                if reload_interval:
+                    timeout = min(timeout, reload_interval) \
+                        if timeout is not None else reload_interval
+                await commands.wait(timeout)
+            else:
+                # nothing is due yet, so let the HTTP side have the loop
+                await commands.wait(translator.idle_time(now))
+        except EOFError:
+            # an overlong reply was thrown away. The request it answered
+            # times out, but the Arduino was heard from.
+            translator.supervisor.heard(time.monotonic())
+        except (OSError, LinkError) as error:
+            link.detach(loop)
+            await loop.run_in_executor(None, translator.recover, error)
+            link.attach(loop)
+
+        if translator.rate_report_interval and now >= next_rate_report:
+            next_rate_report = now + translator.rate_report_interval
+            translator.print_rate_report()
+
+
+async def handle_scratch_client(reader, writer, handler=GetHandler):
+    """
+    This coroutine answers the HTTP GET requests of one Scratch
+    connection, the same way handler, a GetHandler class, does. HTTP/1.1
+    connections are kept open for further requests until the client
+    closes them.
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            words = request_line.split()
+
+            # only the Connection header matters here
+            keep_alive = len(words) == 3 and words[2] == b'HTTP/1.1'
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.partition(b':')
+                if name.strip().lower() == b'connection':
+                    keep_alive = value.strip().lower() == b'keep-alive'
+
+            content_type = scratch_translator.HTML_CONTENT_TYPE
+            status = scratch_translator.OK_STATUS
+            if len(words) >= 2 and words[0] == b'GET':
+                # skip over the / in the command
+                cmd = words[1].decode('latin-1')[1:]
+                if cmd == 'crossdomain.xml':
+                    response = handler.policy()
+                elif cmd == 'metrics':
+                    response = handler.metrics()
+                    content_type = metrics.CONTENT_TYPE
+                else:
+                    response = handler.scratch_reply(cmd)
+                    status = scratch_translator.reply_status(response)
+            else:
+                keep_alive = False
+                response = "unsupported request"
+            writer.write(scratch_translator.http_response(response,
+                                                          keep_alive,
+                                                          content_type,
+                                                          status))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def watch_config(watcher):
+    """
+    This coroutine does the work of ConfigWatcher.run() on the event loop
+    """
+    while True:
+        await asyncio.sleep(watcher.interval)
+        watcher.check()
+
+
+async def run(boards, profiles, watcher=None):
+    """
+    This coroutine runs the translators of all boards and the Scratch
+    HTTP servers of all profiles on one event loop. Commands are handed
+    from the HTTP side to the Arduino side through the command router of
+    each profile, which appends them to the AsyncCommandQueue of the
+    board they belong to. watcher is a ConfigWatcher, or None if the
+    configuration files are not watched.
+
+    Every translator must already have passed is_arduino_ready().
+    """
+    loop = asyncio.get_running_loop()
+
+    links = []
+    for board in boards:
+        board.commands = AsyncCommandQueue(board.commands)
+        board.translator.command_deque = board.commands
+        link = AsyncArduinoSerial(board.arduino)
+        link.attach(loop)
+        links.append(link)
+
+    servers = []
+    for profile in profiles:
+        port = profile.config.http.port
+
+        print("HTTP Serverport is initialized with port = %s\n" % (port))
+        handler = GetHandler.for_profile()
+        handler.set_items(profile.reporter_store,
+                          profile.command_router,
+                          port,
+                          profile.config)
+        profile.handler = handler
+        try:
+            servers.append(await asyncio.start_server(
+                functools.partial(handle_scratch_client, handler=handler),
+                'localhost', port))
+            print('Starting Scratch HTTP Server!')
+        except Exception:
+            print('HTTP Socket may already be in use - restart Scratch')
+            raise
+    print('Use <Ctrl-C> to exit the extension\n')
+    print('Waiting for Scratch handshake ....')
+
+    tasks = [server.serve_forever() for server in servers]
+    tasks.extend(run_translator(board.translator, link)
+                 for board, link in zip(boards, links))
+    if watcher is not None:
+        tasks.append(watch_config(watcher))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for server in servers:
+            server.close()
+        for link in links:
+            link.detach(loop)
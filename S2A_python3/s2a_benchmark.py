@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+Benchmarks for the serial -> reporter -> HTTP pipeline.
+
+The end to end run drives a board_emulator.PtyBoard through an
+unmodified ArduinoSerial, ArduinoTranslator and Scratch HTTP server,
+while one client polls and another sends commands. The microbenchmarks
+time the individual steps. The results are printed, or written to a
+file, as JSON so that runs on different commits can be compared.
+
+    python s2a_benchmark.py [-c config_file] [-s seconds] [-o results.json]
+
+The configuration file supplies the pin setup and options. Its ComPort
+and PORT are replaced by the emulated board and a free local port.
+Pseudo-terminals are needed, so this only runs on POSIX systems.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import timeit
+import argparse
+import platform
+import threading
+import subprocess
+import tracemalloc
+import contextlib
+import http.client
+import tempfile
+import configparser
+
+import board_emulator
+import arduino_serial
+import arduino_translator
+import command_queue
+import reporter_store
+import reply_parser
+import s2a_config
+import scratch_translator
+
+
+def default_config_file():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "configFiles", "CodeShield.cfg")
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    return: a dictionary of percentile name -> value, plus the count,
+            mean and max, for a list of numbers
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    result = {"count": len(ordered),
+              "mean": sum(ordered) / len(ordered),
+              "max": ordered[-1]}
+    for point in points:
+        index = min(len(ordered) - 1, int(len(ordered) * point / 100.0))
+        result["p%d" % (point)] = ordered[index]
+    return result
+
+
+def free_port():
+    """
+    return: a local TCP port that is not in use
+    """
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(
+                                           os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except Exception:
+        return None
+
+
+def write_benchmark_config(config_file, com_port, http_port):
+    """
+    Copy config_file with the serial and HTTP ports replaced
+
+    return: the name of the copy
+    """
+    Config = configparser.ConfigParser()
+    Config.optionxform = str
+    Config.read(config_file)
+    Config.set("SerialPortSection", "ComPort", com_port)
+    Config.set("HTTPServerSection", "PORT", str(http_port))
+    handle, name = tempfile.mkstemp(suffix=".cfg", prefix="s2a_benchmark_")
+    with os.fdopen(handle, "w") as config:
+        Config.write(config)
+    return name
+
+
+def benchmark_command(translator):
+    """
+    return: the name of a one parameter analog or digital command, and
+            the largest value it takes
+    """
+    for wanted, largest in (("analog", 255), ("digital", 1)):
+        for name, frame in sorted(translator.templates.commands.items()):
+            if frame.pin_type == wanted and frame.num_params == 1:
+                return name, largest
+    return None, 0
+
+
+class Pipeline:
+    """
+    An emulated board, translator and Scratch HTTP server, set up the way
+    s2a.py sets them up with the thread runtime
+    """
+
+    def __init__(self, config_file, baud_rate):
+        self.board = board_emulator.PtyBoard(baud_rate)
+        com_port = self.board.start()
+        self.http_port = free_port()
+        self.config_file = write_benchmark_config(config_file, com_port,
+                                                  self.http_port)
+        self.config = s2a_config.load(self.config_file)
+        self.stop = threading.Event()
+
+        self.reporter_store = reporter_store.ReporterStore()
+        self.commands = command_queue.CommandQueue(self.config)
+        self.arduino = arduino_serial.ArduinoSerial(self.config)
+        self.arduino.open()
+        self.translator = arduino_translator.ArduinoTranslator(
+            self.arduino, self.reporter_store, self.commands, self.config)
+        if not self.translator.is_arduino_ready():
+            raise RuntimeError("the emulated board does not respond")
+        self.translator.start()
+        self.server = scratch_translator.make_server(
+            self.reporter_store, self.commands, self.config)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        threading.Thread(target=self.wander, daemon=True).start()
+
+    def wander(self):
+        """
+        Keep the emulated sensors changing, so that every poll is a new
+        sample for Scratch
+        """
+        emulator = self.board.emulator
+        step = 0
+        while not self.stop.is_set():
+            step += 1
+            for pin in (12, 13):
+                emulator.set_input(pin, step & 1)
+            for pin in range(14, 20):
+                emulator.set_input(pin, (step * (pin + 1)) % 1024)
+            emulator.encoder_position = step
+            time.sleep(0.002)
+
+    def translator_cpu_time(self):
+        """
+        return: CPU seconds used by the translator thread, or None where
+                per thread CPU clocks are not available
+        """
+        try:
+            return time.clock_gettime(
+                time.pthread_getcpuclockid(self.translator.ident))
+        except (AttributeError, OSError):
+            return None
+
+    def poll_client(self, latencies):
+        connection = http.client.HTTPConnection('localhost', self.http_port)
+        while not self.stop.is_set():
+            started = time.monotonic()
+            connection.request("GET", "/poll")
+            connection.getresponse().read()
+            latencies.append(time.monotonic() - started)
+        connection.close()
+
+    def command_client(self, sent, name, largest, interval):
+        connection = http.client.HTTPConnection('localhost', self.http_port)
+        value = 0
+        while not self.stop.is_set():
+            value = (value + 1) % (largest + 1)
+            started = time.monotonic()
+            connection.request("GET", "/%s/%d" % (name, value))
+            connection.getresponse().read()
+            sent.append((started, value))
+            time.sleep(interval)
+        connection.close()
+
+    def command_latencies(self, sent, name):
+        """
+        Find each command's frame in what the board received, in order
+
+        return: (list of GET to serial write latencies, number of
+                 commands that were never written)
+        """
+        stream = bytearray()
+        offsets = []
+        for arrival, data in list(self.board.log):
+            offsets.append((len(stream), arrival))
+            stream += data
+
+        def arrival_at(offset):
+            arrival = None
+            for start, chunk_arrival in offsets:
+                if start > offset:
+                    break
+                arrival = chunk_arrival
+            return arrival
+
+        latencies = []
+        missing = 0
+        position = 0
+        for started, value in sent:
+            frame = self.translator.command_frame([name, str(value)],
+                                                  False)
+            found = stream.find(frame, position)
+            if found < 0:
+                # replaced by a newer value before it was sent
+                missing += 1
+                continue
+            position = found + len(frame)
+            latencies.append(arrival_at(found) - started)
+        return latencies, missing
+
+    def close(self):
+        self.stop.set()
+        self.server.shutdown()
+        os.unlink(self.config_file)
+
+
+def run_end_to_end(config_file, seconds, baud_rate, command_interval):
+    """
+    return: the end to end results
+    """
+    pipeline = Pipeline(config_file, baud_rate)
+    translator = pipeline.translator
+    name, largest = benchmark_command(translator)
+
+    # let the poll rates settle before measuring
+    time.sleep(min(1.0, seconds / 4.0))
+    poll_latencies = []
+    sent = []
+    clients = [threading.Thread(target=pipeline.poll_client,
+                                args=(poll_latencies,), daemon=True)]
+    if name is not None:
+        clients.append(threading.Thread(target=pipeline.command_client,
+                                        args=(sent, name, largest,
+                                              command_interval),
+                                        daemon=True))
+    first_log = len(pipeline.board.log)
+    # values received per reporter, so that a readMany poll counts once
+    # for every reporter it reads
+    samples_started = dict(translator.reporter_samples)
+    cpu_started = pipeline.translator_cpu_time()
+    started = time.monotonic()
+    for client in clients:
+        client.start()
+    time.sleep(seconds)
+    pipeline.stop.set()
+    elapsed = time.monotonic() - started
+    cpu_finished = pipeline.translator_cpu_time()
+    samples_finished = dict(translator.reporter_samples)
+    for client in clients:
+        client.join(2)
+
+    # only look at what was written during the measurement
+    del pipeline.board.log[:first_log]
+    command_latencies, missing = pipeline.command_latencies(sent, name)
+    pipeline.close()
+
+    samples_per_second = {}
+    for label, count in samples_finished.items():
+        samples_per_second[label] = \
+            (count - samples_started.get(label, 0)) / elapsed
+    results = {
+        "seconds": elapsed,
+        "samples_per_second": samples_per_second,
+        "total_samples_per_second": sum(samples_per_second.values()),
+        "poll_latency_seconds": percentiles(poll_latencies),
+        "command": name,
+        "command_write_latency_seconds": percentiles(command_latencies),
+        "commands_sent": len(sent),
+        "commands_not_written": missing,
+        "ack_failures": translator.ack_failures,
+        "bytes_dropped_by_board": pipeline.board.dropped,
+    }
+    if cpu_started is not None and cpu_finished is not None:
+        cpu = cpu_finished - cpu_started
+        samples = results["total_samples_per_second"] * elapsed
+        results["translator_cpu_seconds"] = cpu
+        results["translator_cpu_fraction"] = cpu / elapsed
+        results["translator_cpu_seconds_per_sample"] = \
+            cpu / samples if samples else None
+    return results
+
+
+class ReplyFeed:
+    """
+    Write canned replies into a pseudo-terminal for ArduinoSerial to read
+    """
+
+    def __init__(self, reply, count):
+        self.master, slave = os.openpty()
+        board_emulator.tty.setraw(slave)
+        self.slave = slave
+        self.path = os.ttyname(slave)
+        self.data = reply * count
+
+    def start(self):
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def write(self):
+        os.write(self.master, self.data)
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+def run_micro(config_file, number):
+    """
+    return: the microbenchmark results, in seconds per call
+    """
+    results = {}
+    reply = b'{"pinValue":{"type":"analog", "pin":16, "value":512}}\n'
+
+    # ArduinoSerial.read_line over a real serial device
+    feed = ReplyFeed(reply, number)
+    com_config = write_benchmark_config(config_file, feed.path, free_port())
+    arduino = arduino_serial.ArduinoSerial(com_config)
+    arduino.open()
+    feed.start()
+    started = time.perf_counter()
+    for count in range(number):
+        arduino.read_line()
+    results["read_line"] = (time.perf_counter() - started) / number
+    arduino.close()
+    feed.close()
+
+    # the translator is only used for its frames and reply handling, it
+    # is never started
+    store = reporter_store.ReporterStore()
+    translator = arduino_translator.ArduinoTranslator(
+        arduino, store, command_queue.CommandQueue(com_config), com_config)
+    translator.reporter_map = translator.templates.reporter_map
+    for label in translator.reporter_map.values():
+        store.add(label)
+    os.unlink(com_config)
+
+    name, largest = benchmark_command(translator)
+    if name is not None:
+        command = [name, str(largest)]
+        results["command_frame"] = timeit.timeit(
+            lambda: translator.command_frame(command, False),
+            number=number) / number
+
+    # every reply carries a new value, so every one is rendered
+    text = reply.decode().strip()
+    values = iter(range(10 ** 9))
+    if "16" in translator.reporter_map:
+        replies = [text.replace("512", str(value % 1024))
+                   for value in range(number)]
+        started = time.perf_counter()
+        for line in replies:
+            translator.process_reply(line)
+        results["process_reply_and_render"] = \
+            (time.perf_counter() - started) / number
+
+        # the memory blocks each sample still holds afterwards, and the
+        # most memory in use at any one time. Objects that are freed
+        # again before the end only show in the peak.
+        tracemalloc.start()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        tracemalloc.reset_peak()
+        for line in replies:
+            translator.process_reply(line)
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        tracemalloc.stop()
+        retained = sum(stat.count_diff for stat in
+                       after.compare_to(before, "filename"))
+        results["retained_blocks_per_sample"] = retained / number
+        results["traced_peak_bytes"] = peak
+
+    label = next(iter(store.values), None)
+    if label is not None:
+        results["reporter_update_and_render"] = timeit.timeit(
+            lambda: store.update(label, next(values)),
+            number=number) / number
+
+    # what a Scratch poll costs the HTTP side
+    handler = scratch_translator.GetHandler.for_profile()
+    handler.set_items(store, command_queue.CommandQueue(config_file),
+                      0, config_file)
+    handler.waiting_for_first_scratch_poll = False
+    results["scratch_poll_reply"] = timeit.timeit(
+        lambda: scratch_translator.http_response(
+            handler.scratch_reply("poll"), True),
+        number=number) / number
+
+    parsed = reply_parser.benchmark(number)
+    results["reply_parsing"] = dict(
+        (line, {"json_loads": loads / number,
+                "parse_pin_value": parser / number})
+        for line, (loads, parser) in parsed.items())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the serial -> reporter -> HTTP pipeline "
+                    "against an emulated board")
+    parser.add_argument("-c", "--config", default=default_config_file(),
+                        help="configuration file with the pin setup")
+    parser.add_argument("-s", "--seconds", type=float, default=10.0,
+                        help="length of the end to end run")
+    parser.add_argument("-b", "--baud", type=int, default=115200,
+                        help="baud rate of the emulated board")
+    parser.add_argument("-i", "--command-interval", type=float,
+                        default=0.02,
+                        help="seconds between commands from the client")
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="repetitions of each microbenchmark")
+    parser.add_argument("-o", "--output",
+                        help="write the results to this file")
+    parser.add_argument("--micro-only", action="store_true",
+                        help="skip the end to end run")
+    arguments = parser.parse_args()
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": os.path.basename(arguments.config),
+        "baud_rate": arguments.baud,
+    }
+    # the extension's own messages would get mixed into the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results["micro"] = run_micro(arguments.config, arguments.number)
+        if not arguments.micro_only:
+            results["end_to_end"] = run_end_to_end(
+                arguments.config, arguments.seconds, arguments.baud,
+                arguments.command_interval)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2013 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+The configuration of one board and its Scratch profile, read from a
+.cfg file once, at startup.
+
+load() reads and checks the whole file and returns an S2AConfig. Pin
+numbers, parameter counts, rates and timeouts are converted to numbers
+there, optional settings get their defaults, and every mistake is
+reported with the section and option it was found in, before the serial
+port is opened. The result is made of tuples and read-only mappings, so
+it can be handed to every part of the extension without any of them
+being able to change it for the others.
+"""
+
+import os
+import types
+import configparser
+from collections import namedtuple
+
+
+class ConfigError(ValueError):
+    """
+    A configuration file that cannot be used
+    """
+    pass
+
+
+SerialPortConfig = namedtuple("SerialPortConfig",
+                              "com_port baud_rate timeout protocol "
+                              "batched_init")
+
+# times are in seconds, a heartbeat_interval or stall_timeout of 0 turns
+# that check off
+LinkConfig = namedtuple("LinkConfig",
+                        "heartbeat_interval stall_timeout reconnect_delay "
+                        "max_reconnect_delay")
+
+# port is an int, or None for the extra board files of [BoardSection],
+# which do not need an HTTP server of their own
+HTTPServerConfig = namedtuple("HTTPServerConfig", "port threaded")
+
+# an entry of [CommandPinMapSection]. pin_type is "digital", "analog" or
+# "None" for the commands that have templates of their own.
+CommandSpec = namedtuple("CommandSpec", "name pin num_params pin_type")
+
+# an entry of [ArduinoInitialOutputPinValues]
+OutputValue = namedtuple("OutputValue", "pin pin_type value")
+
+# times are in seconds
+PollingConfig = namedtuple("PollingConfig",
+                           "poll_window bulk_read rate_report_interval "
+                           "reply_timeout")
+
+# times are in seconds, trace_log is a file name or None, a max_depth of
+# 0 is no limit
+CommandQueueConfig = namedtuple("CommandQueueConfig",
+                                "one_shot_commands max_latency link_share "
+                                "ack_window ack_timeout latency_window "
+                                "trace_log max_depth overflow")
+
+S2AConfig = namedtuple("S2AConfig",
+                       "config_file project serial http runtime "
+                       "pin_directions initial_outputs reporter_pins "
+                       "reporter_map commands templates "
+                       "special_led_processing polling command_queue "
+                       "boards reporter_deadbands reporter_poll_rates "
+                       "reload_interval link")
+S2AConfig.__doc__ = """
+The parsed configuration file.
+
+pin_directions is a tuple of (pin, mode) pairs, initial_outputs a tuple
+of OutputValues and reporter_pins a tuple of (pin, type) pairs, where
+the pin is "encoder" for the encoder. reporter_map maps a pin to its
+Scratch label, commands maps a command name to its CommandSpec and
+templates maps a [JsonStringTemplateSection] name to its template
+string. boards holds the S2AConfigs of the further boards listed in
+[BoardSection]. reload_interval is in seconds, 0 if the files are not
+watched for changes. link holds the LinkConfig of the serial link
+supervision.
+"""
+
+
+# the values the sketch understands
+pin_types = ("digital", "analog")
+pin_modes = ("input", "output")
+protocols = ("json", "binary")
+runtimes = ("thread", "asyncio")
+overflow_policies = ("reject", "drop_oldest", "drop_oldest_same_pin")
+
+# the templates every configuration file must have
+required_templates = ("writeValueToPin", "setPinDirection", "readPinValue",
+                      "writeServo", "writePiezo")
+
+
+def load(config):
+    """
+    Read and check a configuration file, and the files of the further
+    boards it lists. config may also be an S2AConfig that was loaded
+    before, which is handed back as it is.
+
+    return: the S2AConfig. Raises ConfigError if a file cannot be read
+            or has a mistake in it.
+    """
+    if isinstance(config, S2AConfig):
+        return config
+    return ConfigReader(config).read()
+
+
+def board_configs(config):
+    """
+    return: the S2AConfigs of all boards config sets up, its own first
+    """
+    config = load(config)
+    return (config,) + config.boards
+
+
+def read_only(mapping):
+    return types.MappingProxyType(dict(mapping))
+
+
+class ConfigReader:
+    """
+    This class reads one configuration file into an S2AConfig
+    """
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.parser = configparser.ConfigParser()
+        try:
+            found = self.parser.read(config_file)
+        except configparser.Error as error:
+            raise ConfigError("%s: %s" % (config_file, error))
+        if not found:
+            raise ConfigError("%s: cannot read the configuration file" %
+                              (config_file))
+
+    def error(self, section, option, message):
+        return ConfigError("%s: [%s] %s: %s" % (self.config_file, section,
+                                                option, message))
+
+    def items(self, section, required=True):
+        """
+        return: the (option, value) pairs of a section, in file order. A
+                missing optional section has none.
+        """
+        if not self.parser.has_section(section):
+            if required:
+                raise ConfigError("%s: the [%s] section is missing" %
+                                  (self.config_file, section))
+            return []
+        return [(option, value.strip())
+                for option, value in self.parser.items(section)]
+
+    def get(self, section, option, default=None):
+        """
+        return: the stripped text of an option, or default if it is not
+                there. Without a default the option is required.
+        """
+        if self.parser.has_option(section, option):
+            return self.parser.get(section, option).strip()
+        if default is None:
+            raise self.error(section, option, "missing")
+        return default
+
+    def integer(self, section, option, default=None, minimum=None):
+        return self.convert(section, option, default, int, minimum,
+                            "a whole number")
+
+    def number(self, section, option, default=None, minimum=0):
+        return self.convert(section, option, default, float, minimum,
+                            "a number")
+
+    def convert(self, section, option, default, kind, minimum, described):
+        text = self.get(section, option, str(default)
+                        if default is not None else None)
+        try:
+            value = kind(text)
+        except ValueError:
+            raise self.error(section, option, "%r is not %s" %
+                             (text, described))
+        if minimum is not None and value < minimum:
+            raise self.error(section, option, "%r is less than %s" %
+                             (text, minimum))
+        return value
+
+    def boolean(self, section, option, default=None):
+        text = self.get(section, option, str(default)
+                        if default is not None else None)
+        try:
+            return self.parser.BOOLEAN_STATES[text.lower()]
+        except KeyError:
+            raise self.error(section, option, "%r is not True or False" %
+                             (text))
+
+    def choice(self, section, option, choices, default=None):
+        text = self.get(section, option, default)
+        if text not in choices:
+            raise self.error(section, option, "%r is not one of %s" %
+                             (text, ", ".join(choices)))
+        return text
+
+    def pin(self, section, option, text=None):
+        """
+        return: a pin number as an int
+        """
+        if text is None:
+            text = option
+        try:
+            pin = int(text)
+        except ValueError:
+            pin = -1
+        if not 0 <= pin <= 255:
+            raise self.error(section, option, "%r is not a pin number" %
+                             (text))
+        return pin
+
+    def label(self, section, option, labels):
+        """
+        labels maps the lower case Scratch labels of [ReporterMapSection]
+        to the labels themselves
+
+        return: the Scratch label an option names
+        """
+        if option not in labels:
+            raise self.error(section, option, "is not a Scratch label of "
+                             "[ReporterMapSection]")
+        return labels[option]
+
+    def read(self, follow_boards=True):
+        """
+        Only the main configuration file lists further boards. Their own
+        [BoardSection] is not followed.
+
+        return: the S2AConfig
+        """
+        serial = SerialPortConfig(
+            self.get("SerialPortSection", "ComPort"),
+            self.integer("SerialPortSection", "BaudRate", minimum=1),
+            self.number("SerialPortSection", "TimeOut"),
+            self.choice("SerialPortSection", "Protocol", protocols, "json"),
+            self.boolean("SerialPortSection", "BatchedInit", False))
+
+        link = LinkConfig(
+            self.number("SerialPortSection", "HeartbeatInterval", 1),
+            self.number("SerialPortSection", "StallTimeout", 3),
+            self.number("SerialPortSection", "ReconnectDelay", 0.5,
+                        minimum=0.1),
+            self.number("SerialPortSection", "MaxReconnectDelay", 8))
+        if link.max_reconnect_delay < link.reconnect_delay:
+            raise self.error("SerialPortSection", "MaxReconnectDelay",
+                             "is less than ReconnectDelay")
+
+        if self.parser.has_section("HTTPServerSection"):
+            http = HTTPServerConfig(
+                self.integer("HTTPServerSection", "PORT", minimum=1),
+                self.boolean("HTTPServerSection", "Threaded", False))
+        else:
+            http = HTTPServerConfig(None, False)
+
+        section = "ArduinoPinDirection"
+        pin_directions = tuple(
+            (self.pin(section, pin),
+             self.choice(section, pin, pin_modes))
+            for pin, mode in self.items(section))
+
+        section = "ArduinoInitialOutputPinValues"
+        initial_outputs = []
+        for pin, type_value in self.items(section):
+            pin_type, _, value = type_value.partition(',')
+            pin_type = pin_type.strip()
+            if pin_type not in pin_types:
+                raise self.error(section, pin, "%r is not one of %s" %
+                                 (pin_type, ", ".join(pin_types)))
+            try:
+                value = int(value)
+            except ValueError:
+                raise self.error(section, pin, "%r has no whole number "
+                                 "value" % (type_value))
+            initial_outputs.append(OutputValue(self.pin(section, pin),
+                                               pin_type, value))
+
+        section = "ReporterPinToTypeMap"
+        reporter_pins = []
+        for pin, pin_type in self.items(section):
+            if pin != "encoder":
+                pin = self.pin(section, pin)
+            if pin_type not in pin_types:
+                raise self.error(section, str(pin), "%r is not one of %s" %
+                                 (pin_type, ", ".join(pin_types)))
+            reporter_pins.append((pin, pin_type))
+
+        section = "ReporterMapSection"
+        reporter_map = read_only((self.pin(section, pin), label)
+                                 for pin, label in self.items(section))
+        for pin, pin_type in reporter_pins:
+            # the sketch reports the encoder as pin 14
+            if (14 if pin == "encoder" else pin) not in reporter_map:
+                raise self.error("ReporterPinToTypeMap", str(pin),
+                                 "has no Scratch label in "
+                                 "[ReporterMapSection]")
+
+        section = "CommandPinMapSection"
+        commands = {}
+        for name, descriptor in self.items(section):
+            elements = [element.strip() for element in descriptor.split(',')]
+            if len(elements) != 3:
+                raise self.error(section, name, "%r is not PIN, "
+                                 "#_OF_PARAMETERS, TYPE" % (descriptor))
+            pin_type = elements[2]
+            if pin_type not in pin_types + ("None",):
+                raise self.error(section, name, "%r is not one of %s" %
+                                 (pin_type, ", ".join(pin_types + ("None",))))
+            try:
+                num_params = int(elements[1])
+            except ValueError:
+                num_params = -1
+            if num_params < 0:
+                raise self.error(section, name, "%r is not a number of "
+                                 "parameters" % (elements[1]))
+            commands[name] = CommandSpec(name,
+                                         self.pin(section, name, elements[0]),
+                                         num_params, pin_type)
+
+        section = "JsonStringTemplateSection"
+        templates = dict(self.items(section))
+        for name in required_templates:
+            self.get(section, name)
+        # older configuration files may not have a readEncoder entry.
+        # In that case derive it from readPinValue the way it always was.
+        templates.setdefault("readencoder",
+                             templates["readpinvalue"].replace(
+                                 "\"pin\":PIN", "\"encoder\":100"))
+        # configparser lowers the option names, the templates are looked
+        # up by the names the file uses
+        templates = read_only((name, templates[name.lower()])
+                              for name in required_templates +
+                              ("readEncoder",))
+
+        special_led_processing = self.boolean(
+            "SpecialProcessing", "enable_special_LED_processing")
+
+        polling = PollingConfig(
+            self.integer("PollingSection", "PollWindow", 1, minimum=1),
+            self.boolean("PollingSection", "BulkRead", False),
+            self.number("PollingSection", "RateReportInterval", 0),
+            self.number("PollingSection", "ReplyTimeout", 1000) / 1000.0)
+
+        section = "CommandQueueSection"
+        one_shot_commands = frozenset(
+            name.strip() for name in
+            self.get(section, "OneShotCommands", "piezo_tone").split(',')
+            if name.strip())
+        trace_log = self.get(section, "TraceLog", "") or None
+        command_queue = CommandQueueConfig(
+            one_shot_commands,
+            self.number(section, "MaxCommandLatency", 100) / 1000.0,
+            self.number(section, "ActuatorLinkShare", 0.5),
+            self.integer(section, "AckWindow", 1, minimum=1),
+            self.number(section, "AckTimeout", 1000) / 1000.0,
+            self.integer(section, "LatencyWindow", 100, minimum=1),
+            trace_log,
+            self.integer(section, "MaxQueueDepth", 0, minimum=0),
+            self.choice(section, "OverflowPolicy", overflow_policies,
+                        "reject"))
+
+        # further boards are named relative to this file
+        boards = ()
+        if follow_boards:
+            directory = os.path.dirname(self.config_file)
+            boards = tuple(
+                ConfigReader(os.path.join(directory, name.strip())).read(
+                    follow_boards=False)
+                for name in self.get("BoardSection", "Boards", "").split(',')
+                if name.strip())
+
+        # configparser hands option names out in lower case, so the
+        # Scratch labels are matched without regard to case
+        labels = dict((label.lower(), label)
+                      for label in reporter_map.values())
+
+        section = "ReporterDeadbandSection"
+        reporter_deadbands = read_only(
+            (self.label(section, option, labels),
+             self.integer(section, option, minimum=0))
+            for option, deadband in self.items(section, required=False))
+
+        section = "ReporterPollRateSection"
+        reporter_poll_rates = read_only(
+            (self.label(section, option, labels),
+             self.number(section, option))
+            for option, rate in self.items(section, required=False))
+
+        return S2AConfig(
+            self.config_file,
+            self.get("ProjectNameSection", "Project", ""),
+            serial, http,
+            self.choice("RuntimeSection", "Runtime", runtimes, "thread"),
+            pin_directions, tuple(initial_outputs), tuple(reporter_pins),
+            reporter_map, read_only(commands), templates,
+            special_led_processing, polling, command_queue, boards,
+            reporter_deadbands, reporter_poll_rates,
+            self.number("RuntimeSection", "ReloadInterval", 0), link)
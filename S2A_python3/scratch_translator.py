@@ -22,7 +22,23 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from http.server import BaseHTTPRequestHandler
 from http.server import HTTPServer
-import configparser
+from socketserver import ThreadingMixIn
+import time
+import threading
+import metrics
+import s2a_config
+import command_trace
+from command_queue import CommandQueueFull
+
+
+# the content type of every reply but the /metrics page
+HTML_CONTENT_TYPE = "text/html; charset=ISO-8859-1"
+
+# a command that is turned away by a full command queue is answered with
+# this text and a 503, so that a script can tell it apart and back off
+QUEUE_FULL_REPLY = "command queue full: "
+OK_STATUS = "200 OK"
+QUEUE_FULL_STATUS = "503 Service Unavailable"
 
 
 class GetHandler(BaseHTTPRequestHandler):
@@ -30,53 +46,88 @@ class GetHandler(BaseHTTPRequestHandler):
     This class contains the HTTP server that Scratch2 will connect to
     sends HTTP GET requests to the Arduino microcontroller.
     
-    It shares the scratch reporter dictionary, reporter lock and command
-    deque with the arduino_translator class
+    It shares the reporter store and command deque with the
+    arduino_translator class
     
     HTTP GET requests are accepted, verified and then passed on to the
     arduino translator via a shared deque.
     
     Reporter information is continously updated by the arduino_translator.
     When a poll request is received, the latest and greatest is reported 
-    back to scratch in one big happy block.
+    back to scratch in one big happy block, already rendered by the
+    reporter store.
     """
     
     # shared resources with arduino_translator 
-    scratch_reporter_dict = None
-    reporter_lock = None 
+    reporter_store = None
     command_deque = None
     
     # tcp server port read from config file
     port = None
     
-    #command to pin map
-    command_pin_map_dict = None
+    # command name -> the number of parameters it takes
+    command_params = None
     
     #indicator so that we can tell user Scratch is ready to go
     waiting_for_first_scratch_poll = True
+
+    # for the /metrics page: the poll requests served, those answered
+    # with stale values, and when the server was set up
+    poll_requests = 0
+    stale_polls = 0
+    started = None
+
+    # seconds an idle keep-alive connection is held open before the
+    # handling thread gives up on it
+    keep_alive_timeout = 60
     
     # this is a classmethod because we need to set data before starting
     # the HTTP server.
     @classmethod
-    def set_items(self, scratch_reporter_dict, 
-                             reporter_lock, 
+    def for_profile(self):
+        """
+        This method returns a subclass of this handler with class
+        attributes of its own, so that each configuration profile
+        served by this process keeps its own reporter store, command
+        queue and command map.
+        """
+        return type(self.__name__, (self,), {})
+
+    @classmethod
+    def set_items(self, reporter_store,
                              command_deque,
                              port,
-                             config_file):
+                             config):
         """
         This method stores the input parameters for later use.
         It is a classmethod, because these values need to established
-        prior to instantiating the class
+        prior to instantiating the class. config is an S2AConfig, or the
+        name of a configuration file.
         """
-        self.scratch_reporter_dict = scratch_reporter_dict
-        self.reporter_lock = reporter_lock
+        self.reporter_store = reporter_store
         self. command_deque = command_deque
         self.port = port
-        self.config_file = config_file
+        self.set_config(config)
+        self.started = time.monotonic()
+
+    @classmethod
+    def set_config(self, config):
+        """
+        This method takes the commands Scratch may send from config, an
+        S2AConfig or the name of a configuration file. It is called again
+        when the configuration is reloaded.
+        """
+        self.config = s2a_config.load(config)
+        self.config_file = self.config.config_file
         
-        Config = configparser.ConfigParser()
-        Config.read(self.config_file)
-        self.command_pin_map_dict = dict(Config.items("CommandPinMapSection"))
+        # the commands of every board, the first board to list a command
+        # gets it. The map is swapped in whole, so a request being
+        # handled sees either the old or the new one.
+        command_params = {}
+        for board_config in reversed(s2a_config.board_configs(self.config)):
+            for name, spec in board_config.commands.items():
+                command_params[name] = spec.num_params
+        self.command_params = command_params
 
     def do_GET(self):
         """
@@ -90,6 +141,8 @@ class GetHandler(BaseHTTPRequestHandler):
         self.cmd =  self.path[1:]
         if self.cmd == 'crossdomain.xml':
           self.sendPolicy()
+        elif self.cmd == 'metrics':
+          self.send_resp(self.metrics(), metrics.CONTENT_TYPE)
         else:
           self.do_ScratchCmd(self.cmd)
         return
@@ -99,30 +152,38 @@ class GetHandler(BaseHTTPRequestHandler):
       """
       This method returns cross domain policy back to Scratch upon request.
       """
+      self.send_resp(self.policy())
+      return
+
+    @classmethod
+    def policy(self):
+      """
+      This method builds the cross domain policy text
+      """
       policy = "<cross-domain-policy>\n"
       policy += "  <allow-access-from domain=\"*\" to-ports=\""
       policy += str(self.port)
       policy += "\"/>\n"
       policy += "</cross-domain-policy>\n\0"
-      self.send_resp(policy)
-      return
+      return policy
+
+    @classmethod
+    def metrics(self):
+      """
+      This method builds the /metrics page of this profile
+      """
+      return metrics.render(self)
     
     # we can't use the standard send_respone since we don't conform to its 
     # standards, so we craft our own response handler here
-    def send_resp(self, response):
+    def send_resp(self, response, content_type=HTML_CONTENT_TYPE,
+                  status=OK_STATUS):
       """
       This method sends Scratch an HTTP response to an HTTP GET command.
       """
-      crlf = "\r\n"
-      httpResponse = "HTTP/1.1 200 OK" + crlf
-      httpResponse += "Content-Type: text/html; charset=ISO-8859-1" + crlf
-      httpResponse += "Access-Control-Allow-Origin: *" + crlf
-      httpResponse += crlf 
-      # add the response to the nonsense above
-      httpResponse += response + crlf
-
       # send it out the door to Scratch
-      self.wfile.write(httpResponse.encode('utf-8') )  
+      self.wfile.write(http_response(response, not self.close_connection,
+                                     content_type, status))
       
     # handle all scratch commands
     # test only for known commands and throw out all others
@@ -132,84 +193,167 @@ class GetHandler(BaseHTTPRequestHandler):
         This method processes scratch HTTP GET commands requesting reporter data
         in the form of a "poll" or a command request to affect an actuator.
         """
+        response = self.scratch_reply(cmd)
+        self.send_resp(response, status=reply_status(response))
+
+    @classmethod
+    def scratch_reply(self, cmd):
+        """
+        This method carries out a Scratch poll or command request and
+        returns the text of the reply, as a string or as encoded bytes.
+        It does not depend on how the request arrived, so any front end
+        can use it.
+        """
         if cmd == "poll":
+            # a plain increment, a count lost to a race between two
+            # server threads does not matter here
+            self.poll_requests += 1
+            if self.reporter_store.is_stale():
+                self.stale_polls += 1
+
             # if this the first poll received, let user know scratch
             # is now ready to interact
-            if GetHandler.waiting_for_first_scratch_poll:
-                GetHandler.waiting_for_first_scratch_poll = False
-                print('Scratch is initialized and ready to Rock n Roll')
+            if self.waiting_for_first_scratch_poll:
+                self.waiting_for_first_scratch_poll = False
+                print('Scratch is initialized and ready to Rock n Roll on '
+                      'port %s' % (self.port))
             else:
                 pass
 
-            s = ""
-            self.reporter_lock.acquire(True)
-            # check to see if there is something to report
-            if len(self.scratch_reporter_dict):
-                for reporter, data in list(self.scratch_reporter_dict.items()):
-                    s += reporter
-                    s += ' '
-                    s += str(data)
-                    s += '\n\r'
-            #nothing there, just return OK
-            else:
-                s = "okay" 
-             
-            self.send_resp(s)
-            self.reporter_lock.release()
+            # the reporter store keeps the reply ready to go, so there is
+            # no lock to take and nothing to build here
+            return self.reporter_store.poll_body()
         else:
+            received = time.monotonic()
             # check to if this is a valid command
             # split the command from any parameters - '/' is delimiter
             split_command = cmd.split('/')
 
             #check to see if this is a valid command
-            if split_command[0] in self.command_pin_map_dict:
-                # make sure the correct number of parameters were supplied
-                # first get the value for the command out of the dictionary
-                command_value = self.command_pin_map_dict.get(split_command[0])
-                
-                #now split the data using comma as the delimiter
-                value_list = command_value.split(',')
-                
+            num_params = self.command_params.get(split_command[0])
+            if num_params is not None:
                 # compare the number of expected parameters and 
                 # the number of parameters in the command
-                if int(value_list[1])!= (len(split_command) - 1):
-                    self.send_resp("wrong number of parameters: " + cmd)
+                if num_params != (len(split_command) - 1):
+                    return "wrong number of parameters: " + cmd
                 else:
-                    self. command_deque.append(split_command)
-                    self.send_resp("okay")
+                    try:
+                        self. command_deque.append( \
+                            command_trace.TracedCommand(split_command, \
+                                                        received))
+                    except CommandQueueFull:
+                        return QUEUE_FULL_REPLY + cmd
+                    except KeyError:
+                        # the command router has not caught up with a
+                        # reloaded configuration yet
+                        return "unknown command: " + cmd
+                    return "okay"
             # not a valid command
             else:
-                self.send_resp("unknown command: " + cmd)
+                return "unknown command: " + cmd
 
-def start_server(scratch_reporter_dict, 
-                 reporter_lock, 
-                 command_deque,
-                 config_file):
+
+def reply_status(response):
     """
-       This function populates class variables with essential data and 
-       instantiates the HTTP Server
+    return: the HTTP status of a reply of GetHandler.scratch_reply()
+    """
+    if isinstance(response, str) and response.startswith(QUEUE_FULL_REPLY):
+        return QUEUE_FULL_STATUS
+    return OK_STATUS
+
+
+def http_response(response, keep_alive=False,
+                  content_type=HTML_CONTENT_TYPE, status=OK_STATUS):
+    """
+    This function wraps the text of a reply in the HTTP response that
+    Scratch expects. The body is sent with its length, so the connection
+    can be kept open for the next request when keep_alive is True.
+
+    return: the response as bytes
+    """
+    if isinstance(response, str):
+        response = response.encode('utf-8')
+    body = response + b"\r\n"
+    crlf = "\r\n"
+    httpResponse = "HTTP/1.1 " + status + crlf
+    httpResponse += "Content-Type: " + content_type + crlf
+    httpResponse += "Access-Control-Allow-Origin: *" + crlf
+    httpResponse += "Content-Length: " + str(len(body)) + crlf
+    if not keep_alive:
+        httpResponse += "Connection: close" + crlf
+    httpResponse += crlf 
+    # add the response to the nonsense above
+    return httpResponse.encode('utf-8') + body
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTPServer that handles each connection in its own thread, so that
+    a slow or idle client does not hold up the polls of another
+    """
+    daemon_threads = True
+
+
+def make_server(reporter_store,
+                command_deque,
+                config):
+    """
+       This function populates the class variables of a handler for one
+       configuration profile and instantiates its HTTP Server. config
+       is an S2AConfig, or the name of a configuration file.
+
+       return: the server, not yet started
     """
-    Config = configparser.ConfigParser()
-    Config.read(config_file)    
-    port = Config.get("HTTPServerSection", "PORT")
+    config = s2a_config.load(config)
+    port = config.http.port
     
     print("HTTP Serverport is initialized with port = %s\n" % (port))
-    GetHandler.set_items(scratch_reporter_dict, 
-                             reporter_lock, 
+    handler = GetHandler.for_profile()
+    handler.set_items(reporter_store,
                              command_deque,
                              port,
-                             config_file)
+                             config)
+    # a threaded server can hold connections open between requests,
+    # the single threaded one has to close them to stay available
+    if config.http.threaded:
+        handler.protocol_version = "HTTP/1.1"
+        handler.timeout = handler.keep_alive_timeout
+        server_class = ThreadedHTTPServer
+    else:
+        server_class = HTTPServer
+
     try:
-        server = HTTPServer(('localhost', int(port)), GetHandler)
+        server = server_class(('localhost', port), handler)
         print('Starting Scratch HTTP Server!')
-        print('Use <Ctrl-C> to exit the extension\n')
-        print('Waiting for Scratch handshake ....')
     except Exception:
         print('HTTP Socket may already be in use - restart Scratch')
         raise
+    return server
+
+
+def start_server(reporter_store,
+                 command_deque,
+                 config):
+    """
+       This function populates class variables with essential data and 
+       instantiates the HTTP Server
+    """
+    serve_forever([make_server(reporter_store, command_deque, config)])
+
+
+def serve_forever(servers):
+    """
+       This function runs the HTTP servers of all configuration profiles.
+       The last one runs in the calling thread, the others in threads of
+       their own.
+    """
+    print('Use <Ctrl-C> to exit the extension\n')
+    print('Waiting for Scratch handshake ....')
+    for server in servers[:-1]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
     try:
         #start the server
-        server.serve_forever()
+        servers[-1].serve_forever()
     except KeyboardInterrupt:
         print("Goodbye !")
         raise KeyboardInterrupt
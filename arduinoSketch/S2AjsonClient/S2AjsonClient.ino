@@ -31,6 +31,27 @@ long encoderPosition = -999 ;
 int servoPosition = 0 ;
 
 long position = -999 ;
+
+// The compact binary protocol. After {"query":"binary"} every message,
+// in both directions, is one fixed size record:
+//   SYNC, opcode, pin, type (or mode), value (4 bytes, signed, most
+//   significant byte first), param (2 bytes, unsigned, most significant
+//   byte first), checksum (sum of the bytes from opcode to param)
+// A piezo write carries the frequency in value and the duration in param.
+// A '{' where a record should start puts the sketch back into JSON mode.
+#define SYNC 0xA5
+#define RECORD_SIZE 11
+#define OP_READ 0x01
+#define OP_WRITE 0x02
+#define OP_MODE 0x03
+#define OP_PIN_VALUE 0x81
+#define OP_ACK 0x82
+#define TYPE_ENCODER 5
+
+short binary_protocol = 0 ;
+
+// a character that read_char() should hand out again
+int pushed_back = -1 ;
 /*
  * Simple Arduino proxy; does what it's told
  * via the USB connection, and reports back
@@ -49,7 +70,10 @@ long position = -999 ;
  * {"read":{"pin":4,"type":"analog"}}                 // Return the value of analog pin 4 (0-1023)
  * {"write":{"type":"piezo","freq":440,"time":1000}} // set the piezo device for the time duaration and frequency
  * {"write":{"type":"servo","value":90, "pin":5}}      // set the servo position
+ * {"readMany":{"digital":[12,13],"analog":[16,17],"encoder":14}} // return all of the listed values in one reply
  * {"read":{"encoder":100,"type":"analog"}}            // return encoder value - numerical parameter is not used but                                                      //                        needs to be filled in
+ * {"query":"binary"}                                  // switch to binary records, replies {"protocol":"binary"}
+ * {"init":{"input":[12,13],"output":[2,6],"digital":[2,0],"analog":[6,32]}} // set up many pins, one {} when all went well
  */
 
 /* This is a modification of the work done by Chris Warburton http://chriswarbo.net/index.php?page=cedi&type=misc&id=1%2F3%2F6%2F10
@@ -70,6 +94,10 @@ void loop()
   // Look for some commands in JSON
   char* input = 0;
 
+  if (binary_protocol) {
+    read_record();
+    return;
+  }
 
   input = read_json();
 
@@ -92,21 +120,151 @@ char read_char()
   // on the USB cable (this will loop
   // forever if you don't send it anything)
   char data = -1;
-  while ((Serial.available() < 0) || (data < 0)) {
-    delay(1);
-    data = Serial.read();
-
+  if (pushed_back >= 0) {
+    data = pushed_back;
+    pushed_back = -1;
+    return data;
+  }
+  while (data < 0) {
     // get encoder data in this loop
     long newPos = encoder.read();
     if (newPos != encoderPosition) {
       encoderPosition = newPos;
     }
 
+    // only pause when there is nothing to read. When several requests
+    // are sent back to back, the 64 byte receive buffer has to be
+    // emptied at line speed or it will overflow.
+    if (Serial.available() > 0) {
+      data = Serial.read();
+    }
+    else {
+      delay(1);
+    }
   }
   return data;
 }
 
 
+int read_byte()
+{
+  // Like read_char(), but for binary records, where every value from
+  // 0 to 255 is data
+  int data = -1;
+  while (data < 0) {
+    long newPos = encoder.read();
+    if (newPos != encoderPosition) {
+      encoderPosition = newPos;
+    }
+    if (Serial.available() > 0) {
+      data = Serial.read();
+    }
+    else {
+      delay(1);
+    }
+  }
+  return data;
+}
+
+void read_record()
+{
+  // Reads one binary record and runs it. Anything that is not the start
+  // of a record is discarded, and records with a bad checksum are
+  // dropped without a reply, just like bad JSON.
+  unsigned char record[RECORD_SIZE];
+  unsigned char checksum = 0;
+  int index;
+  int data = read_byte();
+
+  if (data == '{') {
+    // the host has gone back to JSON
+    binary_protocol = 0;
+    pushed_back = data;
+    return;
+  }
+  if (data != SYNC) {
+    return;    // Not in step yet, keep looking
+  }
+  record[0] = data;
+  for (index = 1; index < RECORD_SIZE; index++) {
+    record[index] = read_byte();
+  }
+  for (index = 1; index < RECORD_SIZE - 1; index++) {
+    checksum = checksum + record[index];
+  }
+  if (checksum != record[RECORD_SIZE - 1]) {
+    return;    // Damaged record
+  }
+  run_record(record);
+}
+
+void run_record(unsigned char* record)
+{
+  // Carries out a binary record, using the same helpers as the JSON
+  // handlers
+  unsigned char opcode = record[1];
+  int pin = record[2];
+  short type = record[3];
+  long value = ((long) record[4] << 24) | ((long) record[5] << 16) |
+               ((long) record[6] << 8) | (long) record[7];
+  unsigned int param = ((unsigned int) record[8] << 8) | record[9];
+
+  switch (opcode) {
+  case OP_READ:
+    if (type == 1) {
+      send_record(OP_PIN_VALUE, pin, type, digitalRead(pin));
+    }
+    else if (type == 2) {
+      send_record(OP_PIN_VALUE, pin, type, analogRead(pin));
+    }
+    else if (type == TYPE_ENCODER) {
+      send_record(OP_PIN_VALUE, pin, type, encoderPosition);
+    }
+    break;
+  case OP_WRITE:
+    if (type == 3) {
+      // piezo, the duration goes where write_pin() expects it
+      pin = param;
+    }
+    if ((value <= 32767) && write_pin(type, pin, (int) value)) {
+      send_record(OP_ACK, record[2], type, 0);
+    }
+    break;
+  case OP_MODE:
+    if (set_pin_mode(type, pin)) {
+      send_record(OP_ACK, pin, type, 0);
+    }
+    break;
+  default:
+    break;    // Unknown opcode. Ignore it.
+  }
+}
+
+void send_record(unsigned char opcode, int pin, short type, long value)
+{
+  // Sends one binary record to the host
+  unsigned char record[RECORD_SIZE];
+  unsigned char checksum = 0;
+  int index;
+
+  record[0] = SYNC;
+  record[1] = opcode;
+  record[2] = pin;
+  record[3] = type;
+  record[4] = (value >> 24) & 0xFF;
+  record[5] = (value >> 16) & 0xFF;
+  record[6] = (value >> 8) & 0xFF;
+  record[7] = value & 0xFF;
+  record[8] = 0;
+  record[9] = 0;
+  for (index = 1; index < RECORD_SIZE - 1; index++) {
+    checksum = checksum + record[index];
+  }
+  record[RECORD_SIZE - 1] = checksum;
+  Serial.write(record, RECORD_SIZE);
+}
+
+
 char* read_json()
 {
   // This will wait for some input, then
@@ -579,6 +737,9 @@ void run_command(char* name, char* value) {
   if (compare_strings(name,"read")) {
     run_read(value);    // Read pin values
   }
+  if (compare_strings(name,"readMany")) {
+    run_read_many(value);    // Read a list of pin values in one go
+  }
   if (compare_strings(name,"write")) {
     run_write(value);   // Write pin values
   }
@@ -588,6 +749,9 @@ void run_command(char* name, char* value) {
   if (compare_strings(name,"query")) {
     run_query(value);
   }
+  if (compare_strings(name,"init")) {
+    run_init(value);    // Set up the modes and outputs of many pins
+  }
 }
 
 
@@ -725,6 +889,98 @@ void run_read(char* value) {
   }
 }
 
+void print_pin_value(int pin, long pin_value, short first) {
+  // Prints one "pin":value member of a pinValues reply
+  if (!first) {
+    Serial.print(",");
+  }
+  Serial.print("\"");
+  Serial.print(pin);
+  Serial.print("\":");
+  Serial.print(pin_value);
+}
+
+void run_read_many(char* value) {
+  // Reads every pin that is listed and sends all of the results back
+  // in a single JSON reply, so that a full set of reporters costs one
+  // request and one reply instead of one of each per pin.
+
+  // We should have been given a JSON object such as
+  // {"digital":[12,13],"analog":[16,17],"encoder":14}
+  // Any of the members may be left out.
+  // The reply looks like
+  // {"pinValues":{"12":1,"13":0,"16":512,"17":511,"14":706}}
+  int value_size = json_length(value);
+  int index = 0;   // Loop index for walking the value
+  int pin = -1;    // The pin currently being read
+  int digits = 0;  // The length of the pin digits
+  short type = 0;    // 0 = unknown, 1 = digital, 2 = analog, 3 = encoder
+  short first = 1;   // No comma in front of the first member
+  if (value_size > 2) {    // We want some contents between our '{' and '}'
+    Serial.print("{\"pinValues\":{");
+    index++;    // Skip the '{'
+    // Loop until we reach the '}'
+    while (index < value_size - 1) {
+      if (value[index] != '"') {
+        index++;    // Whitespace and commas are insignificant
+        continue;
+      }
+      type = 0;
+      if (compare_strings(value+index, "digital")) {
+        type = 1;
+      }
+      if (compare_strings(value+index, "analog")) {
+        type = 2;
+      }
+      if (compare_strings(value+index, "encoder")) {
+        type = 3;
+      }
+      index = index + value_length(value+index);    // Skip over the name
+      index = index + skip_space(value+index);    // Skip whitespace
+      if (value[index] != ':') {
+        break;    // No colon. Stop here, but still close the reply.
+      }
+      index++;    // Skip the colon
+      index = index + skip_space(value+index);    // Skip whitespace
+      if (type == 3) {
+        // The encoder is given the pin number it should be reported as
+        pin = (int) compile_digits(value+index);
+        index = index + value_length(value+index);  // Skip over the digits
+        print_pin_value(pin, encoderPosition, first);
+        first = 0;
+        continue;
+      }
+      if (value[index] != '[') {
+        continue;    // Not a list of pins. Ignore it.
+      }
+      index++;    // Skip the '['
+      while ((index < value_size - 1) && (value[index] != ']')) {
+        index = index + skip_space(value+index);    // Skip whitespace and commas
+        if (value[index] == ']') {
+          break;    // End of the list
+        }
+        digits = value_length(value+index);
+        if (digits == 0) {
+          index++;    // Not a number. Ignore it.
+          continue;
+        }
+        pin = (int) compile_digits(value+index);
+        index = index + digits;    // Skip over the digits
+        if (type == 1) {
+          print_pin_value(pin, digitalRead(pin), first);
+          first = 0;
+        }
+        else if (type == 2) {
+          print_pin_value(pin, analogRead(pin), first);
+          first = 0;
+        }
+      }
+      index++;    // Skip the ']'
+    }
+    Serial.print("}}\n");
+  }
+}
+
 void run_write(char* value) {
   // Writes the specified value to the specified pin and sends
   // back some empty JSON. The type must be given, to keep the
@@ -842,62 +1098,71 @@ void run_write(char* value) {
         }
       }
     }
-    if (((type == 1) || (type == 2) || (type == 3) || (type == 4))
-      && (pin > 0) 
-      && (pin_value >= 0)) {
-      if (type == 1) {
-        // Digital. Our value must be 0 or 1.
-        if ((pin_value != 0) && (pin_value != 1)) {
-          return;    // Bail out
-        }
-        switch (pin_value) {
-        case 0:
-          digitalWrite(pin,LOW);
-          break;
-        case 1:
-          digitalWrite(pin,HIGH);
-          break;
-        default:
-          return;    // Bail out.
-        }
-      }
-      if (type == 2) {
-        // analog. Our value must be from 0 to 255.
-        if ((pin_value < 0) || (pin_value > 255)) {
-          return;    // Bail out
-        }
-        analogWrite(pin,pin_value);
-      }
-      if(type == 3 )
-      {
-        // here we use pin for duration and  pin_value for frequency and 
-        // play with the piezo
-       // pin_value = 550 ;
-        //pin = 1000 ;
-        //Serial.println(pin) ;
-        tone(3, pin_value, pin) ;
-        delay(pin) ;
-        noTone(3) ;
+    if (write_pin(type, pin, pin_value)) {
+      Serial.print("{}\n");    // Indicates success newline added by afy
+    }
+  }
+}
 
+short write_pin(short type, int pin, int pin_value) {
+  // Carries out a write for run_write() and run_record(). For a piezo
+  // write pin holds the duration and pin_value the frequency.
+  // Returns 1 if the write was done, 0 if it was refused.
+  if (((type == 1) || (type == 2) || (type == 3) || (type == 4))
+    && (pin > 0) 
+    && (pin_value >= 0)) {
+    if (type == 1) {
+      // Digital. Our value must be 0 or 1.
+      if ((pin_value != 0) && (pin_value != 1)) {
+        return 0;    // Bail out
       }
-      if( type == 4 ) // do servo motion
-      {
-     //   Servo servo ;
-
-        servo.attach(SERVO) ;
- 
-        delay(100) ;
-        servo.write(pin_value) ;
-        delay(300) ;
-        servo.detach() ;
-        delay(300) ;
-        //pinMode(HALL, INPUT) ;
+      switch (pin_value) {
+      case 0:
+        digitalWrite(pin,LOW);
+        break;
+      case 1:
+        digitalWrite(pin,HIGH);
+        break;
+      default:
+        return 0;    // Bail out.
       }
+    }
+    if (type == 2) {
+      // analog. Our value must be from 0 to 255.
+      if ((pin_value < 0) || (pin_value > 255)) {
+        return 0;    // Bail out
+      }
+      analogWrite(pin,pin_value);
+    }
+    if(type == 3 )
+    {
+      // here we use pin for duration and  pin_value for frequency and 
+      // play with the piezo
+     // pin_value = 550 ;
+      //pin = 1000 ;
+      //Serial.println(pin) ;
+      tone(3, pin_value, pin) ;
+      delay(pin) ;
+      noTone(3) ;
 
-      Serial.print("{}\n");    // Indicates success newline added by afy
+    }
+    if( type == 4 ) // do servo motion
+    {
+   //   Servo servo ;
 
+      servo.attach(SERVO) ;
+ 
+      delay(100) ;
+      servo.write(pin_value) ;
+      delay(300) ;
+      servo.detach() ;
+      delay(300) ;
+      //pinMode(HALL, INPUT) ;
     }
+
+    return 1;
   }
+  return 0;
 }
 
 void run_mode(char* value) {
@@ -978,16 +1243,117 @@ void run_mode(char* value) {
         }
       }
     }
-    if (((mode == 1) || (mode == 2)) && (pin > 0)) {
-      if (mode == 1) {
-        // Input
-        pinMode(pin,INPUT);
+    if (set_pin_mode(mode, pin)) {
+      Serial.print("{}\n");    // Indicates success newline added afy
+    }
+  }
+}
+
+short set_pin_mode(short mode, int pin) {
+  // Carries out a mode change for run_mode() and run_record().
+  // Returns 1 if the mode was set, 0 if it was refused.
+  if (((mode == 1) || (mode == 2)) && (pin > 0)) {
+    if (mode == 1) {
+      // Input
+      pinMode(pin,INPUT);
+    }
+    if (mode == 2) {
+      // Output
+      pinMode(pin,OUTPUT);
+    }
+    return 1;
+  }
+  return 0;
+}
+
+void run_init(char* value) {
+  // Sets the mode of every listed pin and writes the initial value of
+  // every listed output, so that a whole board is set up with one
+  // request and one reply instead of one of each per pin.
+
+  // We should have been given a JSON object such as
+  // {"input":[12,13],"output":[2,6],"digital":[2,0],"analog":[6,32]}
+  // where "digital" and "analog" list pin, value pairs. Any of the
+  // members may be left out. They are carried out in the order given.
+  // A single {} is sent back if every mode and write was accepted.
+  int value_size = json_length(value);
+  int index = 0;   // Loop index for walking the value
+  int pin = -1;    // The pin of the pair being read, -1 if none yet
+  int number = 0;  // The number just read
+  int digits = 0;  // The length of the digits
+  short type = 0;    // 0 = unknown, 1 = input, 2 = output, 3 = digital, 4 = analog
+  short success = 1;
+  if (value_size > 2) {    // We want some contents between our '{' and '}'
+    index++;    // Skip the '{'
+    // Loop until we reach the '}'
+    while (index < value_size - 1) {
+      if (value[index] != '"') {
+        index++;    // Whitespace and commas are insignificant
+        continue;
       }
-      if (mode == 2) {
-        // Output
-        pinMode(pin,OUTPUT);
+      type = 0;
+      if (compare_strings(value+index, "input")) {
+        type = 1;
       }
-      Serial.print("{}\n");    // Indicates success newline added afy
+      if (compare_strings(value+index, "output")) {
+        type = 2;
+      }
+      if (compare_strings(value+index, "digital")) {
+        type = 3;
+      }
+      if (compare_strings(value+index, "analog")) {
+        type = 4;
+      }
+      index = index + value_length(value+index);    // Skip over the name
+      index = index + skip_space(value+index);    // Skip whitespace
+      if (value[index] != ':') {
+        return;    // No colon. Abort without a reply.
+      }
+      index++;    // Skip the colon
+      index = index + skip_space(value+index);    // Skip whitespace
+      if ((type == 0) || (value[index] != '[')) {
+        success = 0;    // Not something we know how to set up
+        index = index + value_length(value+index);  // Skip over the value
+        continue;
+      }
+      index++;    // Skip the '['
+      pin = -1;
+      while ((index < value_size - 1) && (value[index] != ']')) {
+        index = index + skip_space(value+index);    // Skip whitespace and commas
+        if (value[index] == ']') {
+          break;    // End of the list
+        }
+        digits = value_length(value+index);
+        if (digits == 0) {
+          index++;    // Not a number. Ignore it.
+          continue;
+        }
+        number = (int) (compile_digits(value+index)+0.5);
+        index = index + digits;    // Skip over the digits
+        if (type <= 2) {
+          // A list of pins to set the mode of
+          if (!set_pin_mode(type, number)) {
+            success = 0;
+          }
+        }
+        else if (pin < 0) {
+          pin = number;    // The first half of a pin, value pair
+        }
+        else {
+          // write_pin() uses 1 for digital and 2 for analog
+          if (!write_pin(type - 2, pin, number)) {
+            success = 0;
+          }
+          pin = -1;
+        }
+      }
+      if (pin >= 0) {
+        success = 0;    // A pin without a value
+      }
+      index++;    // Skip the ']'
+    }
+    if (success) {
+      Serial.print("{}\n");    // Everything was set up
     }
   }
 }
@@ -1003,6 +1369,12 @@ void run_query(char* value) {
     // end knows that it can send commands to us.
     Serial.println("{\"status\":\"ready\"}");
   }
+  if (compare_strings(value, "binary")) {
+    // The host wants binary records from now on. Old sketches do not
+    // answer this at all, which tells the host to stay with JSON.
+    Serial.print("{\"protocol\":\"binary\"}\n");
+    binary_protocol = 1;
+  }
 }
 
 